@@ -0,0 +1,369 @@
+import math
+import numpy as np
+from Intersections import EPS
+
+"""
+Bounding volume hierarchy built with the surface area heuristic (SAH)
+
+Nodes are stored depth first in flat arrays:
+    node_min, node_max - (N, 3) node bounds
+    node_right         - index of the right child of an inner node (left child is
+                         always node + 1)
+    node_start         - first entry in tri_index for a leaf
+    node_count         - number of triangles in a leaf, 0 for inner nodes
+Triangle data (v0, edge1, edge2) is reordered to tri_index order so every leaf is one
+contiguous slice, as are the ray transforms of TriangleMesh.transforms once
+useTransforms is called, leaves then test rays with them instead of Moller-Trumbore
+"""
+
+MAX_LEAF = 4  # leaves are never split below this many triangles
+TRAVERSAL_COST = 1.0  # cost of visiting a node, relative to one triangle test
+
+
+def _area(lo, hi):
+    d = np.maximum(hi - lo, 0.0)
+    return 2.0 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+
+class BVH:
+    def __init__(self, v0, edge1, edge2, max_leaf=MAX_LEAF, ids=None):
+        """
+        :param v0: (F, 3) first vertex of every triangle
+        :param edge1: (F, 3) first edges
+        :param edge2: (F, 3) second edges
+        :param max_leaf: maximum number of triangles a leaf is allowed to keep without
+            checking SAH
+        :param ids: optional (F,) index reported for each triangle, for a BVH over a
+            subset of a mesh (default: 0 to F - 1)
+        """
+        v0 = np.asarray(v0, dtype=np.float64)
+        edge1 = np.asarray(edge1, dtype=np.float64)
+        edge2 = np.asarray(edge2, dtype=np.float64)
+        ids = np.arange(len(v0)) if ids is None else np.asarray(ids, dtype=np.int64)
+        pts = np.stack([v0, v0 + edge1, v0 + edge2], axis=1)
+        self.max_leaf = max_leaf
+        self._build(pts.min(axis=1), pts.max(axis=1))
+        order = self.tri_index
+        self.tri_index = ids[order]
+        # position of each id in tri_index, -1 for ids that are not in this BVH
+        self.tri_slot = np.full(ids.max() + 1 if len(ids) else 0, -1, dtype=np.int64)
+        self.tri_slot[self.tri_index] = np.arange(len(self.tri_index))
+        self.v0 = np.ascontiguousarray(v0[order])
+        self.edge1 = np.ascontiguousarray(edge1[order])
+        self.edge2 = np.ascontiguousarray(edge2[order])
+        # (F, 3, 4) in tri_index order once useTransforms is called
+        self.transforms = np.zeros((0, 3, 4))
+
+    def useTransforms(self, transforms) -> None:
+        """
+        Test rays with Baldwin-Weber transforms (see Intersections.transformTriangles)
+        from now on
+        :param transforms: (F, 3, 4) transforms of the mesh, indexed like the ids of
+            this BVH
+        """
+        self.transforms = np.ascontiguousarray(transforms[self.tri_index])
+        if hasattr(self, "tris_l"):
+            self._toLists()
+
+    def _build(self, tri_min, tri_max):
+        F = len(tri_min)
+        centroid = (tri_min + tri_max) * 0.5
+        order = np.arange(F)
+        node_min, node_max, node_right, node_start, node_count = [], [], [], [], []
+
+        # explicit stack of (start, end, parent, is right child), processed depth first
+        # (left before right)
+        stack = [(0, F, -1, False)]
+        while stack:
+            start, end, parent, is_right = stack.pop()
+            node = len(node_min)
+            if is_right:
+                node_right[parent] = node
+            ids = order[start:end]
+            lo = tri_min[ids].min(axis=0) if end > start else np.zeros(3)
+            hi = tri_max[ids].max(axis=0) if end > start else np.zeros(3)
+            node_min.append(lo)
+            node_max.append(hi)
+            node_right.append(-1)
+            node_start.append(start)
+            node_count.append(end - start)
+
+            n = end - start
+            if n <= self.max_leaf:
+                continue
+            split = self._sahSplit(ids, tri_min, tri_max, centroid, _area(lo, hi))
+            if split is None:
+                continue
+            axis, k, sorted_ids = split
+            order[start:end] = sorted_ids
+            node_count[node] = 0
+            mid = start + k
+            stack.append((mid, end, node, True))
+            stack.append((start, mid, node, False))
+
+        self.node_min = np.array(node_min, dtype=np.float64).reshape(-1, 3)
+        self.node_max = np.array(node_max, dtype=np.float64).reshape(-1, 3)
+        self.node_right = np.array(node_right, dtype=np.int64)
+        self.node_start = np.array(node_start, dtype=np.int64)
+        self.node_count = np.array(node_count, dtype=np.int64)
+        self.tri_index = order
+
+    def _sahSplit(self, ids, tri_min, tri_max, centroid, node_area):
+        """
+        Sweep all split positions along all three axes and return the cheapest one
+        :return: (axis, number of triangles on the left, ids sorted along axis) or None
+            if a leaf is cheaper
+        """
+        n = len(ids)
+        best_cost = n  # cost of keeping this node as a leaf (per unit of node area)
+        best = None
+        for axis in range(3):
+            sorted_ids = ids[np.argsort(centroid[ids, axis], kind="stable")]
+            lo = tri_min[sorted_ids]
+            hi = tri_max[sorted_ids]
+            # bounds of the first i triangles and of the last n - i triangles
+            left = _area(np.minimum.accumulate(lo), np.maximum.accumulate(hi))[:-1]
+            right = _area(
+                np.minimum.accumulate(lo[::-1])[::-1],
+                np.maximum.accumulate(hi[::-1])[::-1],
+            )[1:]
+            counts = np.arange(1, n)
+            cost = TRAVERSAL_COST + (left * counts + right * (n - counts)) / max(
+                node_area, 1e-300
+            )
+            i = int(np.argmin(cost))
+            if cost[i] < best_cost:
+                best_cost = cost[i]
+                best = (axis, i + 1, sorted_ids)
+        if best is None and n > 4 * self.max_leaf:
+            # SAH prefers a leaf but the node is too big (overlapping triangles), fall
+            # back to a median split
+            axis = int(np.argmax(np.ptp(centroid[ids], axis=0)))
+            best = (axis, n // 2, ids[np.argsort(centroid[ids, axis], kind="stable")])
+        return best
+
+    def __len__(self):
+        return len(self.node_min)
+
+    def _slabs(self, node, st, inv):
+        """
+        :return: entry distance of the ray into node, inf if it misses
+        """
+        lo = self.node_min_l[node]
+        hi = self.node_max_l[node]
+        tmin = 0.0
+        tmax = math.inf
+        for a in range(3):
+            t1 = (lo[a] - st[a]) * inv[a]
+            t2 = (hi[a] - st[a]) * inv[a]
+            if t1 > t2:
+                t1, t2 = t2, t1
+            if t1 > tmin:
+                tmin = t1
+            if t2 < tmax:
+                tmax = t2
+            if tmin > tmax:
+                return math.inf
+        return tmin
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in list(state):
+            if key.endswith("_l") or key == "_leaf":  # rebuilt by _toLists
+                del state[key]
+        return state
+
+    def _toLists(self):
+        # python lists/floats are much faster than numpy for the handful of boxes and
+        # triangles each ray visits
+        # they are private to the process (about 5x the arrays' size), unlike the arrays
+        # they are not shared with pool workers through SharedMesh
+        self.node_min_l = self.node_min.tolist()
+        self.node_max_l = self.node_max.tolist()
+        self.node_right_l = self.node_right.tolist()
+        self.node_start_l = self.node_start.tolist()
+        self.node_count_l = self.node_count.tolist()
+        self.tri_index_l = self.tri_index.tolist()
+        self.tri_slot_l = self.tri_slot.tolist()
+        self.tris_l = np.concatenate([self.v0, self.edge1, self.edge2], axis=1).tolist()
+        self.transforms_l = self.transforms.reshape(-1, 12).tolist()
+        self._leaf = (
+            self._transformLeaf if len(self.transforms) else self._intersectLeaf
+        )
+
+    def _intersectLeaf(self, start, count, st, ray, best, ignore):
+        """
+        Scalar Moller-Trumbore (same as Triangle.intersect) against the triangles of
+        one leaf
+        :param ignore: slot (position in tri_index) of a triangle to skip, -1 for none
+        :return: best updated with any closer hit
+        """
+        sx, sy, sz = st
+        dx, dy, dz = ray
+        for k in range(start, start + count):
+            if k == ignore:
+                continue
+            ax, ay, az, e1x, e1y, e1z, e2x, e2y, e2z = self.tris_l[k]
+            px = dy * e2z - dz * e2y
+            py = dz * e2x - dx * e2z
+            pz = dx * e2y - dy * e2x
+            det = e1x * px + e1y * py + e1z * pz
+            if abs(det) < EPS:
+                continue
+            inv_det = 1.0 / det
+            tx = sx - ax
+            ty = sy - ay
+            tz = sz - az
+            u = (tx * px + ty * py + tz * pz) * inv_det
+            if u < 0.0 or u > 1.0:
+                continue
+            qx = ty * e1z - tz * e1y
+            qy = tz * e1x - tx * e1z
+            qz = tx * e1y - ty * e1x
+            v = (dx * qx + dy * qy + dz * qz) * inv_det
+            if v < 0.0 or u + v > 1.0:
+                continue
+            t = (e2x * qx + e2y * qy + e2z * qz) * inv_det
+            if t < EPS or t >= best[0]:
+                continue
+            best = (t, u, v, k)
+        return best
+
+    def _transformLeaf(self, start, count, st, ray, best, ignore):
+        """
+        _intersectLeaf with the ray transforms, same hits without a cross product
+        per triangle
+        """
+        sx, sy, sz = st
+        dx, dy, dz = ray
+        for k in range(start, start + count):
+            if k == ignore:
+                continue
+            ux, uy, uz, uw, vx, vy, vz, vw, nx, ny, nz, nw = self.transforms_l[k]
+            det = nx * dx + ny * dy + nz * dz
+            if abs(det) < EPS:
+                continue
+            t = -(nx * sx + ny * sy + nz * sz + nw) / det
+            if t < EPS or t >= best[0]:
+                continue
+            u = ux * sx + uy * sy + uz * sz + uw + t * (ux * dx + uy * dy + uz * dz)
+            if u < 0.0 or u > 1.0:
+                continue
+            v = vx * sx + vy * sy + vz * sz + vw + t * (vx * dx + vy * dy + vz * dz)
+            if v < 0.0 or u + v > 1.0:
+                continue
+            best = (t, u, v, k)
+        return best
+
+    def intersect(
+        self, st, ray, t_max=math.inf, ignore=-1
+    ) -> tuple[float, float, float, int]:
+        """
+        Iterative closest hit traversal. Children are visited near first and a node
+        is skipped once its entry distance is further away than the closest hit found
+        so far
+        :param st: ray start, sequence of 3 floats
+        :param ray: ray direction, sequence of 3 floats
+        :param t_max: ignore hits further away than this
+        :param ignore: index of a triangle to skip (the one the ray starts on), -1 for
+            none
+        :return: (t, u, v, index) of the closest hit, index is into the original
+            triangle order, -1 on a miss
+        """
+        if not hasattr(self, "tris_l"):
+            self._toLists()
+        st = [float(x) for x in st]
+        ray = [float(x) for x in ray]
+        inv = [1.0 / x if x != 0 else math.copysign(1e300, x) for x in ray]
+        ignore = self.tri_slot_l[ignore] if 0 <= ignore < len(self.tri_slot_l) else -1
+        best = (t_max, math.nan, math.nan, -1)
+        if not len(self.tri_index) or self._slabs(0, st, inv) == math.inf:
+            return math.inf, math.nan, math.nan, -1
+
+        stack = [(0.0, 0)]
+        while stack:
+            t_entry, node = stack.pop()
+            if t_entry >= best[0]:
+                continue
+            count = self.node_count_l[node]
+            if count:
+                best = self._leaf(self.node_start_l[node], count, st, ray, best, ignore)
+                continue
+            left = node + 1
+            right = self.node_right_l[node]
+            t_left = self._slabs(left, st, inv)
+            t_right = self._slabs(right, st, inv)
+            # push the far child first so the near child is popped next, a missed child
+            # has t = inf
+            if t_left <= t_right:
+                if t_right < best[0]:
+                    stack.append((t_right, right))
+                if t_left < best[0]:
+                    stack.append((t_left, left))
+            else:
+                if t_left < best[0]:
+                    stack.append((t_left, left))
+                if t_right < best[0]:
+                    stack.append((t_right, right))
+        if best[3] < 0:
+            return math.inf, math.nan, math.nan, -1
+        return best[0], best[1], best[2], self.tri_index_l[best[3]]
+
+    def occluded(self, st, ray, t_max=math.inf, ignore=-1) -> bool:
+        """
+        Any hit traversal, stops at the first triangle found closer than t_max
+        :param st: ray start, sequence of 3 floats
+        :param ray: ray direction, sequence of 3 floats
+        :param t_max: only hits closer than this count
+        :param ignore: index of a triangle to skip (the one the ray starts on), -1 for
+            none
+        :return: True if the ray hits anything before t_max
+        """
+        if not hasattr(self, "tris_l"):
+            self._toLists()
+        st = [float(x) for x in st]
+        ray = [float(x) for x in ray]
+        inv = [1.0 / x if x != 0 else math.copysign(1e300, x) for x in ray]
+        ignore = self.tri_slot_l[ignore] if 0 <= ignore < len(self.tri_slot_l) else -1
+        if not len(self.tri_index):
+            return False
+        miss = (t_max, math.nan, math.nan, -1)
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self._slabs(node, st, inv) >= t_max:
+                continue
+            count = self.node_count_l[node]
+            if count:
+                hit = self._leaf(self.node_start_l[node], count, st, ray, miss, ignore)
+                if hit[3] >= 0:
+                    return True
+                continue
+            stack.append(self.node_right_l[node])
+            stack.append(node + 1)
+        return False
+
+    def intersectRays(
+        self, starts, rays, ignore=None
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Closest hits for a batch of rays, see intersect
+        :param starts: (R, 3) ray starts or a single (3,) start
+        :param rays: (R, 3) ray directions
+        :param ignore: optional (R,) index of a triangle to skip for each ray, -1 for
+            none
+        :return: arrays (t, u, v, index) of length R
+        """
+        rays = np.atleast_2d(np.asarray(rays, dtype=np.float64))
+        starts = np.broadcast_to(np.asarray(starts, dtype=np.float64), rays.shape)
+        ignore = np.broadcast_to(
+            -1 if ignore is None else ignore, (len(rays),)
+        ).tolist()
+        out = [
+            self.intersect(s, d, ignore=i)
+            for s, d, i in zip(starts.tolist(), rays.tolist(), ignore)
+        ]
+        if not out:
+            return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64)
+        t, u, v, i = zip(*out)
+        return np.array(t), np.array(u), np.array(v), np.array(i, dtype=np.int64)
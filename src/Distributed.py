@@ -0,0 +1,346 @@
+import collections
+import glob
+import itertools
+import os
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from tqdm import tqdm
+from TriangleMesh import TriangleMesh
+from Emitters import PointSource
+from twobounce2 import (
+    TEXTURE_FILE,
+    TEXTURE_SIZE,
+    TwobounceSession,
+    addTextureCounts,
+    asMesh,
+    print,
+    saveTextures,
+)
+from HitRecords import hitHeader
+
+"""
+Run one trace job across several machines
+
+A Coordinator splits a run into chunks of rays (Emitters rays are numbered and seeded,
+so a chunk traces the same rays wherever it runs) and serves them over TCP. Worker nodes
+(serveWorker, or "python Distributed.py host:port file.obj [engine]") load the same
+geometry, which is checked against the coordinator's by TriangleMesh.digest, and trace
+each chunk on all their cores with a TwobounceSession. They send back the chunk's stats
+dictionary and, in "full" mode, its hits in the session's output format, which the
+coordinator writes to ./output/hits_node<n>.bin (binary, see HitRecords) or
+./output/output_node<n>.txt. In "texture" mode the stats carry the hit counts of the
+texture pixels hit (at the nodes' texture size), which the coordinator sums into
+twobounce2.TEXTURE_FILE
+
+Chunks held by a worker whose connection drops (or that does not answer within timeout
+seconds) are handed out again, and every chunk is counted once. Workers stay connected
+between runs and reconnect if the coordinator restarts
+
+Messages are pickled by multiprocessing.connection, which authenticates both ends with
+authkey. Anyone holding the key can run code on the coordinator and its workers, so
+there is no default key: pass one or set TWOBOUNCE_AUTHKEY on every machine. The
+coordinator only listens on localhost unless given another address, only open it to a
+network you trust
+"""
+
+PORT = 5200
+AUTHKEY_ENV = "TWOBOUNCE_AUTHKEY"  # environment variable read when no authkey is passed
+# rays per chunk sent to a worker node, each node splits it over its cores
+REMOTE_CHUNK = 1 << 18
+DEPTH = 2  # chunks queued on each worker node, so it never waits for the next one
+# seconds without an answer after which a worker node is treated as dead
+TIMEOUT = 600.0
+
+
+def authKey(authkey=None) -> bytes:
+    """
+    :param authkey: shared secret of the coordinator and its workers (default: None,
+        read AUTHKEY_ENV)
+    :return: the key as bytes
+    """
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError(
+            f"No authkey, pass one or set {AUTHKEY_ENV} (the same on every machine)"
+        )
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+class _Job:
+    """
+    State of one Coordinator.run, shared by the connection threads (guarded by
+    Coordinator._cond)
+    """
+
+    def __init__(self, N, mode, emitter, chunk, object_names):
+        self.object_names = object_names
+        self.mode = mode
+        self.emitter = emitter
+        self.todo = collections.deque(
+            (b0, min(b0 + chunk, N)) for b0 in range(0, N, chunk)
+        )
+        self.count = len(self.todo)
+        self.results = {}  # first ray -> stats
+        self.files = {}  # worker node -> open output file
+        self.texture = {}  # summed "texture" counts, see twobounce2.addTextureCounts
+        self.texture_size = TEXTURE_SIZE  # pixels per side of the worker nodes' counts
+        self.finished = False
+
+    def add(self, node, b0, b1, stats, hits) -> bool:
+        """
+        :return: True if the chunk was new (a re-issued chunk can come back twice)
+        """
+        if b0 in self.results:
+            return False
+        if "texture" in stats:  # (index, counts, texture size) of the pixels hit
+            index, counts, self.texture_size = stats.pop("texture")
+            addTextureCounts(self.texture, index, counts, self.texture_size)
+        self.results[b0] = stats
+        if hits and isinstance(hits, bytes):  # binary records without the header
+            if node not in self.files:
+                self.files[node] = open(f"./output/hits_node{node}.bin", "wb")
+                self.files[node].write(hitHeader(self.object_names))
+            self.files[node].write(hits)
+        elif hits:
+            if node not in self.files:
+                self.files[node] = open(f"./output/output_node{node}.txt", "w")
+            self.files[node].write(hits)
+        return True
+
+
+class Coordinator:
+    """
+    Serve trace jobs to worker nodes
+
+        with Coordinator(mesh) as coordinator:
+            stats = coordinator.run(100_000_000, SobolSource(seed=0))
+    """
+
+    def __init__(
+        self,
+        objs,
+        address=("localhost", PORT),
+        authkey=None,
+        chunk=REMOTE_CHUNK,
+        timeout=TIMEOUT,
+    ):
+        """
+        :param objs: list of objects or TriangleMesh, workers must load the same
+            geometry
+        :param address: (host, port) to listen on (default: localhost only, ("", PORT)
+            listens on every interface)
+        :param authkey: shared secret of the coordinator and its workers (default: None,
+            read from TWOBOUNCE_AUTHKEY, raises ValueError if neither is set)
+        :param chunk: rays per chunk
+        :param timeout: seconds to wait for a chunk before giving up on its worker node
+        """
+        authkey = authKey(authkey)
+        mesh = asMesh(objs)
+        self.digest = mesh.digest()
+        self.object_names = mesh.object_names
+        self.chunk = chunk
+        self.timeout = timeout
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.nodes = 0  # connected worker nodes
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._job = None
+        self._closed = False
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # closed, a wrong key or a client that hung up
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        """
+        Talk to one worker node: check its geometry, then feed it chunks of every job
+        """
+        node = next(self._ids)
+        counted = False
+        try:
+            _, digest, processes = conn.recv()
+            if digest != self.digest:
+                conn.send(("reject", "geometry does not match the coordinator's"))
+                print(f"Rejected worker node {node}, different geometry")
+                return
+            conn.send(("ok", node))
+            print(f"Worker node {node} connected, {processes} cores")
+            with self._cond:
+                self.nodes += 1
+                counted = True
+            job = None
+            while True:
+                with self._cond:
+                    self._cond.wait_for(
+                        lambda: self._closed or self._job not in [None, job]
+                    )
+                    if self._closed:
+                        return
+                    job = self._job
+                self._work(conn, node, job)
+        except (EOFError, OSError, TimeoutError):
+            print(f"Lost worker node {node}")
+        finally:
+            with self._cond:
+                self.nodes -= counted
+            conn.close()
+
+    def _work(self, conn, node, job):
+        """
+        Keep DEPTH chunks of job queued on one worker node until the job is done, chunks
+        it holds go back to the queue if it fails
+        """
+        held = {}
+        try:
+            conn.send(("job", job.mode, job.emitter))
+            while True:
+                with self._cond:
+                    if not held:
+                        self._cond.wait_for(lambda: job.finished or job.todo)
+                        if job.finished:
+                            break
+                    chunks = []
+                    while len(held) + len(chunks) < DEPTH and job.todo:
+                        chunks.append(job.todo.popleft())
+                    held.update(chunks)
+                # sent without the lock, a stalled node must not hold up the others
+                for b0, b1 in chunks:
+                    conn.send(("chunk", b0, b1))
+                if not conn.poll(self.timeout):
+                    raise TimeoutError
+                _, b0, b1, stats, hits = conn.recv()
+                with self._cond:
+                    del held[b0]
+                    job.add(node, b0, b1, stats, hits)
+                    self._cond.notify_all()
+            conn.send(("end",))
+        except BaseException:
+            with self._cond:
+                job.todo.extend(held.items())
+                self._cond.notify_all()
+            raise
+
+    def run(self, N, emitter=None, mode="full") -> list[dict]:
+        """
+        Trace N rays on the connected (and any later connecting) worker nodes
+        :param N: number of rays
+        :param emitter: source from Emitters (default: None, a PointSource at the origin
+            with a random seed)
+        :param mode: "full" writes every hit to ./output (replacing the previous run's
+            output_node files), "texture" writes the hit counts per texture pixel to
+            TEXTURE_FILE, "stats" only counts critical and object hits
+        :return: list of stats dictionaries, one per chunk in ray order (same as
+            TwobounceSession.run)
+        """
+        job = _Job(N, mode, emitter or PointSource(), self.chunk, self.object_names)
+        if mode in ["full", "texture"]:  # hits of an earlier run
+            for filename in glob.glob("./output/output_node*.txt") + glob.glob(
+                "./output/hits_node*.bin"
+            ):
+                os.remove(filename)
+            if os.path.exists(TEXTURE_FILE):
+                os.remove(TEXTURE_FILE)
+        bar = tqdm(
+            total=job.count, leave=False, colour="green", ascii=True, unit="chunk"
+        )
+        with self._cond:
+            self._job = job
+            self._cond.notify_all()
+            while len(job.results) < job.count:
+                self._cond.wait(1.0)
+                bar.update(len(job.results) - bar.n)
+                bar.set_postfix_str(f"{self.nodes} nodes")
+            job.finished = True
+            self._job = None
+            self._cond.notify_all()
+        bar.close()
+        for f in job.files.values():
+            f.close()
+        if mode == "texture":
+            saveTextures(TEXTURE_FILE, job.texture, self.object_names, job.texture_size)
+        return [job.results[b0] for b0 in sorted(job.results)]
+
+    def close(self) -> None:
+        """
+        Disconnect the worker nodes (they wait for a new coordinator) and stop listening
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def serveWorker(
+    address, objs, engine=None, processes=None, authkey=None, retry=5.0
+) -> None:
+    """
+    Trace chunks for a Coordinator until it rejects this node's geometry, reconnecting
+    whenever the connection drops
+    :param address: (host, port) of the coordinator
+    :param objs: list of objects or TriangleMesh, the same geometry as the coordinator's
+    :param engine: intersection engine (default: twobounce2.ENGINE)
+    :param processes: cores to use (default: all)
+    :param authkey: shared secret of the coordinator and its workers (default: None,
+        read from TWOBOUNCE_AUTHKEY, raises ValueError if neither is set)
+    :param retry: seconds between connection attempts
+    """
+    authkey = authKey(authkey)
+    mesh = asMesh(objs)
+    digest = mesh.digest()
+    with TwobounceSession(mesh, engine, processes=processes) as session:
+        while True:
+            try:
+                conn = Client(address, authkey=authkey)
+            except OSError:
+                time.sleep(retry)
+                continue
+            try:
+                conn.send(("hello", digest, session.processes))
+                reply = conn.recv()
+                if reply[0] == "reject":
+                    raise RuntimeError(reply[1])
+                print(f"Connected to {address} as worker node {reply[1]}")
+                job = None
+                while True:
+                    msg = conn.recv()
+                    if msg[0] == "job":
+                        job = (msg[1], msg[2], True)
+                    elif msg[0] == "chunk":
+                        stats, hits = session.traceRange(job, msg[1], msg[2])
+                        conn.send(("result", msg[1], msg[2], stats, hits))
+                    elif msg[0] == "end":
+                        job = None
+            except (EOFError, OSError):
+                print("Lost the coordinator")
+            finally:
+                conn.close()
+            time.sleep(retry)
+
+
+if __name__ == "__main__":
+    # TWOBOUNCE_AUTHKEY=<key> python Distributed.py host:port file.obj [engine]
+    host, port = sys.argv[1].rsplit(":", 1)
+    authkey = authKey()  # fail before loading the geometry
+    serveWorker(
+        (host, int(port)),
+        TriangleMesh.fromObj(sys.argv[2]),
+        sys.argv[3] if len(sys.argv) > 3 else None,
+        authkey=authkey,
+    )
@@ -0,0 +1,333 @@
+import math
+import numpy as np
+
+"""
+Ray sources for iterateStartVecs
+
+Rays are numbered globally and split into fixed size chunks. Chunk k always draws its
+directions from its own stream, SeedSequence(seed, spawn_key=(k,)), which is the k-th
+child SeedSequence(seed).spawn would hand out. Ray i therefore gets the same direction
+whichever process traces it, so a run with a given seed gives identical stats for any
+number of processes
+
+PointSource keeps the original theta/phi distribution, which bunches rays up at the
+poles (its ray weights undo that for the weighted stats). The other sources are uniform
+per unit area of the sphere and differ in how they fill the unit square that is mapped
+onto it: pseudo random (SphereSource), scrambled Sobol (SobolSource), randomized Halton
+(HaltonSource) or a jittered grid per chunk (StratifiedSource). Sobol and Halton chunk
+k takes points k * CHUNK to (k + 1) * CHUNK of one global sequence, so chunks never
+overlap
+"""
+
+# rays per random stream, a power of two (nets for Sobol) and a square (128 x 128 grid)
+CHUNK = 1 << 14
+
+
+class PointSource:
+    """
+    Static point source, theta and phi drawn uniformly (same distribution as the
+    original emitter)
+    """
+
+    def __init__(self, start=(0, 0, 0), seed=None):
+        """
+        :param start: position of the source
+        :param seed: integer seed, a random one is picked (and kept, so every worker
+            agrees) if None
+        """
+        self.start = np.asarray(start, dtype=np.float64)
+        self.seed = np.random.SeedSequence(seed).entropy
+
+    def stream(self, chunk: int) -> np.random.Generator:
+        """
+        :param chunk: chunk number
+        :return: random generator for that chunk
+        """
+        return np.random.default_rng(
+            np.random.SeedSequence(self.seed, spawn_key=(chunk,))
+        )
+
+    def sampleDirections(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        """
+        :param rng: random generator of a chunk
+        :param n: number of directions
+        :return: (n, 3) unit direction vectors
+        """
+        theta = rng.random(n) * math.pi
+        phi = rng.random(n) * 2 * math.pi
+        return np.stack(
+            [np.cos(phi) * np.sin(theta), np.sin(theta) * np.sin(phi), np.cos(theta)],
+            axis=1,
+        )
+
+    def chunk(self, k: int) -> np.ndarray:
+        """
+        :param k: chunk number
+        :return: (CHUNK, 3) directions of rays k * CHUNK to (k + 1) * CHUNK
+        """
+        return self.sampleDirections(self.stream(k), CHUNK)
+
+    def rays(self, n0: int, n: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        :param n0: first ray
+        :param n: one past the last ray
+        :return: (starts, dirs), (n - n0, 3) arrays
+        """
+        if n <= n0:
+            return np.zeros((0, 3)), np.zeros((0, 3))
+        first = n0 // CHUNK
+        last = (n - 1) // CHUNK
+        dirs = np.concatenate([self.chunk(k) for k in range(first, last + 1)])
+        dirs = dirs[n0 - first * CHUNK : n - first * CHUNK]
+        return np.broadcast_to(self.start, dirs.shape), dirs
+
+    def weights(self, dirs) -> np.ndarray:
+        """
+        Weights make weighted fractions unbiased estimates for rays uniform over the
+        sphere: (1 / 4 pi) over the pdf of the direction per solid angle. theta and phi
+        uniform have pdf 1 / (2 pi^2 sin(theta)), so the weight is
+        pi / 2 * sin(theta) = pi / 2 * sqrt(1 - z^2), which averages to 1
+        :param dirs: (n, 3) directions drawn from this source
+        :return: (n,) weight of each ray
+        """
+        dirs = np.asarray(dirs)
+        return math.pi / 2 * np.sqrt(np.maximum(0.0, 1 - dirs[:, 2] ** 2))
+
+    def blocks(self, n0: int, n: int):
+        """
+        Split rays n0 to n at chunk boundaries so no chunk is generated twice
+        :return: generator of (b0, b1) ray ranges
+        """
+        b0 = n0
+        while b0 < n:
+            b1 = min(n, (b0 // CHUNK + 1) * CHUNK)
+            yield b0, b1
+            b0 = b1
+
+
+def squareToSphere(points) -> np.ndarray:
+    """
+    Area preserving map from the unit square to the unit sphere
+    (z = 1 - 2u, phi = 2 pi v)
+    :param points: (n, 2) points in [0, 1)^2
+    :return: (n, 3) unit direction vectors
+    """
+    z = 1 - 2 * points[:, 0]
+    phi = 2 * math.pi * points[:, 1]
+    r = np.sqrt(np.maximum(0.0, 1 - z * z))
+    return np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+
+
+class SphereSource(PointSource):
+    """
+    Static point source, directions uniform over the sphere
+    """
+
+    def unitPoints(self, k: int) -> np.ndarray:
+        """
+        :param k: chunk number
+        :return: (CHUNK, 2) points in the unit square for chunk k
+        """
+        return self.stream(k).random((CHUNK, 2))
+
+    def chunk(self, k: int) -> np.ndarray:
+        return squareToSphere(self.unitPoints(k))
+
+    def weights(self, dirs) -> np.ndarray:
+        """
+        :return: (n,) ones, directions are already uniform over the sphere
+        """
+        return np.ones(len(dirs))
+
+
+def _sobolDirections() -> list[list[int]]:
+    """
+    :return: 32 bit direction numbers of the first two Sobol dimensions (van der Corput
+        and x + 1)
+    """
+    first = [1 << (31 - j) for j in range(32)]
+    m = [1]
+    for j in range(1, 32):
+        m.append((m[-1] << 1) ^ m[-1])
+    second = [m[j] << (31 - j) for j in range(32)]
+    return [first, second]
+
+
+def _scramble(v: int, rows: list[int]) -> int:
+    """
+    Multiply the bits of v (most significant first) by a lower triangular binary matrix
+    :param rows: row r holds the matrix entries of output bit r as a mask over the input
+        bits
+    """
+    out = 0
+    for r, row in enumerate(rows):
+        out |= (bin(v & row).count("1") & 1) << (31 - r)
+    return out
+
+
+class SobolSource(SphereSource):
+    """
+    Static point source, directions from a scrambled 2D Sobol sequence mapped uniformly
+    onto the sphere
+    Scrambling is a random linear matrix scramble plus a random digital shift, shared by
+    all chunks
+    """
+
+    def __init__(self, start=(0, 0, 0), seed=None):
+        super().__init__(start, seed)
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed))
+        self.directions = []
+        self.shift = []
+        for dim in _sobolDirections():
+            # lower triangular with a unit diagonal, bit r depends on input bits 0..r
+            # (most significant first)
+            rows = [
+                (int(rng.integers(0, 1 << r)) << (32 - r) if r else 0) | (1 << (31 - r))
+                for r in range(32)
+            ]
+            self.directions.append(
+                np.array([_scramble(v, rows) for v in dim], dtype=np.uint64)
+            )
+            self.shift.append(np.uint64(rng.integers(0, 1 << 32)))
+
+    def unitPoints(self, k: int) -> np.ndarray:
+        idx = np.arange(k * CHUNK, (k + 1) * CHUNK, dtype=np.uint64)
+        points = np.empty((CHUNK, 2))
+        for dim in range(2):
+            x = np.full(CHUNK, self.shift[dim], dtype=np.uint64)
+            for j in range(32):
+                x ^= ((idx >> np.uint64(j)) & np.uint64(1)) * self.directions[dim][j]
+            points[:, dim] = x * 2.0**-32
+        return points
+
+
+def _radicalInverse(idx, base: int) -> np.ndarray:
+    out = np.zeros(len(idx))
+    scale = 1.0 / base
+    idx = idx.copy()
+    while np.any(idx):
+        out += (idx % base) * scale
+        idx //= base
+        scale /= base
+    return out
+
+
+class HaltonSource(SphereSource):
+    """
+    Static point source, directions from a 2D Halton sequence (bases 2 and 3) mapped
+    uniformly onto the sphere, randomized by one random shift modulo 1
+    (Cranley-Patterson rotation) shared by all chunks
+    """
+
+    def __init__(self, start=(0, 0, 0), seed=None):
+        super().__init__(start, seed)
+        self.shift = np.random.default_rng(np.random.SeedSequence(self.seed)).random(2)
+
+    def unitPoints(self, k: int) -> np.ndarray:
+        idx = np.arange(k * CHUNK, (k + 1) * CHUNK, dtype=np.int64)
+        points = np.stack([_radicalInverse(idx, 2), _radicalInverse(idx, 3)], axis=1)
+        return (points + self.shift) % 1.0
+
+
+class StratifiedSource(SphereSource):
+    """
+    Static point source, every chunk is one jittered m x m grid over the unit square
+    (m = sqrt(CHUNK), any remaining points are pseudo random) mapped uniformly onto the
+    sphere
+    Points are shuffled so a partly traced chunk is still an unbiased sample
+    """
+
+    def unitPoints(self, k: int) -> np.ndarray:
+        rng = self.stream(k)
+        m = math.isqrt(CHUNK)
+        i, j = np.divmod(np.arange(m * m), m)
+        grid = (np.stack([i, j], axis=1) + rng.random((m * m, 2))) / m
+        points = np.concatenate([grid, rng.random((CHUNK - m * m, 2))])
+        return points[rng.permutation(CHUNK)]
+
+
+def _criticalCones(mesh, start) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Cones around the bounding spheres of the critical objects' bounding boxes, as seen
+    from start
+    :return: (axes, cos_max), (C, 3) unit cone axes and (C,) cosine of each cone's half
+        angle
+    """
+    crit = np.nonzero(mesh.object_critical & (mesh.object_end > mesh.object_start))[0]
+    lo = mesh.object_min[crit]
+    hi = mesh.object_max[crit]
+    center = (lo + hi) / 2 - start
+    radius = np.linalg.norm(hi - lo, axis=1) / 2
+    dist = np.linalg.norm(center, axis=1)
+    # start inside the sphere, the whole sphere of directions is needed
+    inside = dist <= radius
+    axes = center / np.where(inside, 1.0, dist)[:, None]
+    axes[inside] = [0.0, 0.0, 1.0]
+    sin_max = np.where(inside, 1.0, radius / np.maximum(dist, 1e-300))
+    cos_max = np.where(inside, -1.0, np.sqrt(np.maximum(0.0, 1 - sin_max**2)))
+    return axes, cos_max
+
+
+class ImportanceSource(SphereSource):
+    """
+    Static point source that sends a fraction of its rays into cones around the critical
+    objects
+    Each ray is uniform over the sphere with probability uniform, otherwise uniform
+    inside one of the cones (picked with equal probability). Weights are
+    (1 / 4 pi) / pdf(direction), so weighted fractions are unbiased estimates for rays
+    uniform over the sphere, including critical hits after a reflection, since the
+    uniform part still covers every direction
+    """
+
+    def __init__(self, mesh, start=(0, 0, 0), seed=None, uniform=0.5):
+        """
+        :param mesh: TriangleMesh, cones are built around its critical objects
+        :param start: position of the source
+        :param seed: integer seed, a random one is picked (and kept, so every worker
+            agrees) if None
+        :param uniform: fraction of rays drawn uniformly over the sphere (must be > 0 to
+            stay unbiased)
+        """
+        super().__init__(start, seed)
+        self.axes, self.cos_max = _criticalCones(mesh, self.start)
+        self.uniform = uniform if len(self.axes) else 1.0
+
+    def chunk(self, k: int) -> np.ndarray:
+        rng = self.stream(k)
+        dirs = squareToSphere(rng.random((CHUNK, 2)))
+        cone = rng.integers(0, max(len(self.axes), 1), CHUNK)
+        in_cone = rng.random(CHUNK) >= self.uniform
+        if not in_cone.any():
+            return dirs
+
+        # uniform inside a cone around +z, rotated onto the cone axis
+        c = cone[in_cone]
+        u = rng.random((len(c), 2))
+        z = 1 - u[:, 0] * (1 - self.cos_max[c])
+        phi = 2 * math.pi * u[:, 1]
+        r = np.sqrt(np.maximum(0.0, 1 - z * z))
+        local = np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+        w = self.axes[c]
+        helper = np.where(np.abs(w[:, [0]]) > 0.9, [[0.0, 1.0, 0.0]], [[1.0, 0.0, 0.0]])
+        a = np.cross(helper, w)
+        a /= np.linalg.norm(a, axis=1)[:, None]
+        b = np.cross(w, a)
+        dirs[in_cone] = local[:, [0]] * a + local[:, [1]] * b + local[:, [2]] * w
+        return dirs
+
+    def weights(self, dirs) -> np.ndarray:
+        pdf = np.full(len(dirs), self.uniform / (4 * math.pi))
+        if len(self.axes):
+            inside = dirs @ self.axes.T >= self.cos_max  # (n, C)
+            cone_pdf = 1 / (2 * math.pi * (1 - self.cos_max) * len(self.axes))
+            pdf += (1 - self.uniform) * (inside * cone_pdf).sum(axis=1)
+        return 1 / (4 * math.pi) / pdf
+
+
+SOURCES = {
+    "thetaphi": PointSource,
+    "random": SphereSource,
+    "sobol": SobolSource,
+    "halton": HaltonSource,
+    "stratified": StratifiedSource,
+}
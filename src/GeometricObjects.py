@@ -143,8 +143,36 @@ class Triangle:
         self.bt = None
         self.ct = None
         self.normal = None
+        self.id = None  # index of this triangle in its TriangleMesh
         self.collisions = []
         self.textureCoords = []
+        self.edge1 = None  # b - a, see precompute
+        self.edge2 = None  # c - a
+        # texture coordinate of a and its change along u and along v
+        self.uvAffine = None
+
+    def precompute(self):
+        """
+        Store the edges and the texture coordinate map, constants of a static triangle
+        that intersect and textureCoordinate would otherwise recompute for every ray
+        (call again if a, b, c or textureCoords change)
+        """
+        self.edge1 = self.b - self.a
+        self.edge2 = self.c - self.a
+        if len(self.textureCoords):
+            (u0, v0), (u1, v1), (u2, v2) = self.textureCoords
+            self.uvAffine = ((u0, v0), (u1 - u0, v1 - v0), (u2 - u0, v2 - v0))
+
+    def textureCoordinate(self, u: float, v: float) -> tuple[float, float]:
+        """
+        :param u: weight of b of a point on the triangle
+        :param v: weight of c
+        :return: texture coordinate of the point
+        """
+        if self.uvAffine is None:
+            self.precompute()
+        (x0, y0), (xu, yu), (xv, yv) = self.uvAffine
+        return x0 + u * xu + v * xv, y0 + u * yu + v * yv
 
     def intersect(self, ray_start, ray_vec) -> tuple[bool, Vector]:
         """
@@ -164,9 +192,11 @@ class Triangle:
         v1, v2, v3 = self.a, self.b, self.c
         eps = 0.000001
 
-        # compute edges
-        edge1 = v2 - v1
-        edge2 = v3 - v1
+        # edges are precomputed
+        if self.edge1 is None:
+            self.precompute()
+        edge1 = self.edge1
+        edge2 = self.edge2
         # pvec = np.cross(ray_vec, edge2)
         pvec = ray_vec.cross(edge2)
         det = edge1.dot(pvec)
@@ -209,6 +239,7 @@ class TriObject:
         self.bounding_box = None
         self.critial = critical
         self.texture = None
+        self.id = None  # index of this object in its TriangleMesh
 
     def initTexture(self, size):
         self.texture = [[(0, 0, 0, 0) for i in range(size)] for j in range(size)]
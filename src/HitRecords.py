@@ -0,0 +1,166 @@
+import json
+import struct
+import sys
+import numpy as np
+
+"""
+Binary hit files
+
+One fixed size record per hit, so a file is a header followed by a plain array that
+readers memory map instead of parsing. Writers only ever append whole blocks of records,
+a file cut at any record boundary (see TwobounceSession.run checkpoints) is still valid
+
+Layout: MAGIC, uint32 length of the JSON header, the JSON header (dtype description and
+object names) padded with spaces so the records start at a multiple of ALIGN bytes, then
+the records
+"""
+
+MAGIC = b"2BNCHIT1"
+ALIGN = 64
+HIT_DTYPE = np.dtype(
+    [
+        ("ray", "<i8"),  # global ray number (emitter ray id)
+        ("bounce", "u1"),  # 0 for the first hit, 1 after the reflection
+        ("object", "<i4"),  # index into the object names of the header
+        ("triangle", "<i4"),  # face index of the TriangleMesh
+        # barycentric coordinates of the hit (weights of the second and third vertex)
+        ("u", "<f4"),
+        ("v", "<f4"),
+        ("tex_u", "<f4"),  # texture coordinates of the hit, what the text format stores
+        ("tex_v", "<f4"),
+        ("position", "<f4", (3,)),
+    ]
+)
+
+
+def hitRecords(mesh, faces, us, vs, first_ray=0) -> np.ndarray:
+    """
+    :param mesh: TriangleMesh
+    :param faces: (n, 2) face hit on each bounce, -1 for no hit (see
+        twobounce2.traceRays)
+    :param us: (n, 2) u of each hit
+    :param vs: (n, 2) v of each hit
+    :param first_ray: ray number of row 0
+    :return: HIT_DTYPE array, one record per hit, bounces of a ray next to each other
+    """
+    rows, bounce = np.nonzero(faces >= 0)
+    f = faces[rows, bounce]
+    u = us[rows, bounce]
+    v = vs[rows, bounce]
+    records = np.empty(len(f), dtype=HIT_DTYPE)
+    records["ray"] = rows + first_ray
+    records["bounce"] = bounce
+    records["object"] = mesh.object_ids[f]
+    records["triangle"] = f
+    records["u"] = u
+    records["v"] = v
+    tex = mesh.textureCoordinates(f, u, v)
+    records["tex_u"] = tex[:, 0]
+    records["tex_v"] = tex[:, 1]
+    records["position"] = (
+        mesh.v0[f] + u[:, None] * mesh.edge1[f] + v[:, None] * mesh.edge2[f]
+    )
+    return records
+
+
+def hitHeader(object_names: list[str]) -> bytes:
+    """
+    :param object_names: names of the objects, record field "object" indexes them
+    :return: file header, MAGIC to the first record
+    """
+    header = json.dumps(
+        {"dtype": HIT_DTYPE.descr, "objects": list(object_names)}
+    ).encode()
+    size = len(MAGIC) + 4 + len(header)
+    header += b" " * (-size % ALIGN)
+    return MAGIC + struct.pack("<I", len(header)) + header
+
+
+def writeHitRecords(file, mesh, faces, us, vs, first_ray=0) -> None:
+    """
+    Append the hits of a block of rays to an open binary hit file, writing the header if
+    the file is empty
+    :param file: file opened with "ab"
+    :param first_ray: ray number of row 0 of faces
+    """
+    if file.tell() == 0:
+        file.write(hitHeader(mesh.object_names))
+    file.write(hitRecords(mesh, faces, us, vs, first_ray).tobytes())
+
+
+def readHeader(filename: str) -> tuple[dict, int]:
+    """
+    :param filename: binary hit file
+    :return: (header, offset of the first record)
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a hit file")
+        (size,) = struct.unpack("<I", f.read(4))
+        return json.loads(f.read(size)), len(MAGIC) + 4 + size
+
+
+def readHits(filename: str) -> tuple[np.ndarray, list[str]]:
+    """
+    Memory map a binary hit file (nothing is read until the records are used)
+    :param filename: binary hit file
+    :return: (HIT_DTYPE records, object names)
+    """
+    header, offset = readHeader(filename)
+    dtype = np.dtype([tuple(field) for field in header["dtype"]])
+    with open(filename, "rb") as f:
+        f.seek(0, 2)
+        count = (f.tell() - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype), header["objects"]
+    return np.memmap(filename, dtype, "r", offset, (count,)), header["objects"]
+
+
+def readRecordBlocks(filename: str, block=1 << 20):
+    """
+    Read a binary hit file a block of records at a time (memory stays at one block,
+    unlike a memory map whose pages stay resident once touched)
+    :param filename: binary hit file
+    :param block: records per block
+    :return: generator of (HIT_DTYPE records, object names)
+    """
+    header, offset = readHeader(filename)
+    dtype = np.dtype([tuple(field) for field in header["dtype"]])
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        while True:
+            records = np.fromfile(f, dtype, block)
+            if len(records) == 0:
+                break
+            yield records, header["objects"]
+
+
+def exportText(records, object_names: list[str], file, block=1 << 20) -> None:
+    """
+    Write hit records in the text format of twobounce2.writeHits (name, bounce, texture
+    coordinates)
+    :param records: HIT_DTYPE records
+    :param object_names: object names of the header
+    :param file: open text file
+    :param block: records formatted at once
+    """
+    for b0 in range(0, len(records), block):
+        r = records[b0 : b0 + block]
+        file.write(
+            "".join(
+                f"{object_names[o]}\t{i}\t{x},{y}\n"
+                for o, i, x, y in zip(
+                    r["object"].tolist(),
+                    r["bounce"].tolist(),
+                    r["tex_u"].astype(np.float64).tolist(),
+                    r["tex_v"].astype(np.float64).tolist(),
+                )
+            )
+        )
+
+
+if __name__ == "__main__":
+    # python HitRecords.py hits_0.bin [...] > hits.txt
+    for filename in sys.argv[1:]:
+        records, names = readHits(filename)
+        exportText(records, names, sys.stdout)
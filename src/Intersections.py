@@ -0,0 +1,214 @@
+import math
+import numpy as np
+
+"""
+Vectorized Moller-Trumbore ray/triangle intersection.
+
+Triangles are passed as packed float64 arrays of shape (F, 3):
+    v0    - first vertex of every triangle (Triangle.a)
+    edge1 - b - a
+    edge2 - c - a
+so one call tests a ray against every triangle at once instead of looping over
+Triangle.intersect
+"""
+
+EPS = 0.000001  # same tolerance as Triangle.intersect
+BLOCK = 1 << 20  # max number of ray/triangle pairs evaluated at once by intersectRays
+
+
+def _cross(a, b):
+    """
+    np.cross without its axis handling overhead, a and b broadcast against each other
+    with 3 as the last axis
+    """
+    a0, a1, a2 = a[..., 0], a[..., 1], a[..., 2]
+    b0, b1, b2 = b[..., 0], b[..., 1], b[..., 2]
+    return np.stack([a1 * b2 - a2 * b1, a2 * b0 - a0 * b2, a0 * b1 - a1 * b0], axis=-1)
+
+
+def transformTriangles(v0, edge1, edge2) -> np.ndarray:
+    """
+    Baldwin-Weber style ray transforms: rows r1, r2, r3 (each with an offset as 4th
+    column) such that for a point p, r1 . p and r2 . p are its barycentric u and v and
+    r3 . p is its distance from the triangle's plane along the (unnormalized) normal
+    edge1 x edge2. A ray o + t * d then hits the plane at t = -(r3 . o) / (r3 . d),
+    where r3 . d is minus the Moller-Trumbore determinant, so the same EPS applies, and
+    u, v follow from two more dot products without any cross product per ray
+    :param v0: (F, 3) first vertices
+    :param edge1: (F, 3) first edges
+    :param edge2: (F, 3) second edges
+    :return: (F, 3, 4) transforms, u and v rows are 0 for degenerate triangles (which
+        never hit)
+    """
+    n = _cross(edge1, edge2)
+    nn = np.einsum("ij,ij->i", n, n)[:, None]
+    rows = np.stack(
+        [
+            np.divide(_cross(edge2, n), nn, out=np.zeros_like(n), where=nn > 0),
+            np.divide(_cross(n, edge1), nn, out=np.zeros_like(n), where=nn > 0),
+            n,
+        ],
+        axis=1,
+    )
+    offsets = -np.einsum("fij,fj->fi", rows, v0)
+    return np.ascontiguousarray(np.concatenate([rows, offsets[:, :, None]], axis=2))
+
+
+def rayBox(lo, hi, st, ray, eps=EPS) -> float:
+    """
+    Scalar slab test of one ray against one axis aligned box (padded by eps)
+    :param lo: minimum corner, sequence of 3 floats
+    :param hi: maximum corner, sequence of 3 floats
+    :param st: ray start, sequence of 3 floats
+    :param ray: ray direction, sequence of 3 floats
+    :return: distance t at which the ray enters the box (0 if it starts inside), inf if
+        it misses
+    """
+    tmin = 0.0
+    tmax = math.inf
+    for a in range(3):
+        if ray[a] == 0:
+            if st[a] < lo[a] - eps or st[a] > hi[a] + eps:
+                return math.inf
+            continue
+        inv = 1.0 / ray[a]
+        t1 = (lo[a] - eps - st[a]) * inv
+        t2 = (hi[a] + eps - st[a]) * inv
+        if t1 > t2:
+            t1, t2 = t2, t1
+        tmin = max(tmin, t1)
+        tmax = min(tmax, t2)
+        if tmin > tmax:
+            return math.inf
+    return tmin
+
+
+def rayBoxes(lo, hi, st, ray, eps=EPS) -> np.ndarray:
+    """
+    Vectorized slab test of one ray against many axis aligned boxes (padded by eps)
+    :param lo: (B, 3) minimum corners
+    :param hi: (B, 3) maximum corners
+    :param st: ray start, array-like of length 3
+    :param ray: ray direction, array-like of length 3
+    :return: (B,) distance t at which the ray enters each box (0 if it starts inside),
+        inf where it misses
+    """
+    st = np.asarray(st, dtype=np.float64)
+    ray = np.asarray(ray, dtype=np.float64)
+    inv = np.divide(1.0, ray, out=np.copysign(1e300, ray), where=ray != 0)
+    t1 = (lo - eps - st) * inv
+    t2 = (hi + eps - st) * inv
+    tmin = np.maximum(np.minimum(t1, t2).max(axis=1), 0.0)
+    tmax = np.maximum(t1, t2).min(axis=1)
+    return np.where(tmin <= tmax, tmin, np.inf)
+
+
+def intersectRay(
+    v0, edge1, edge2, st, ray, eps=EPS, ignore=-1
+) -> tuple[float, float, float, int]:
+    """
+    Find the nearest triangle hit by one ray
+    :param v0: (F, 3) first vertices
+    :param edge1: (F, 3) first edges
+    :param edge2: (F, 3) second edges
+    :param st: ray start, array-like of length 3
+    :param ray: ray direction, array-like of length 3
+    :param eps: tolerance for parallel rays and minimum t
+    :param ignore: index of a triangle to skip (the one the ray starts on), -1 or out of
+        range for none
+    :return: (t, u, v, index) of the closest hit, index is -1 (and t is inf) on a miss
+    """
+    st = np.asarray(st, dtype=np.float64)
+    ray = np.asarray(ray, dtype=np.float64)
+
+    pvec = _cross(ray, edge2)
+    det = np.einsum("ij,ij->i", edge1, pvec)
+    valid = np.abs(det) >= eps
+    inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=valid)
+
+    tvec = st - v0
+    u = np.einsum("ij,ij->i", tvec, pvec) * inv_det
+    valid &= (u >= 0.0) & (u <= 1.0)
+
+    qvec = _cross(tvec, edge1)
+    v = (qvec @ ray) * inv_det
+    valid &= (v >= 0.0) & (u + v <= 1.0)
+
+    t = np.einsum("ij,ij->i", edge2, qvec) * inv_det
+    valid &= t >= eps
+    if 0 <= ignore < len(valid):
+        valid[ignore] = False
+
+    if not valid.any():
+        return np.inf, np.nan, np.nan, -1
+    t = np.where(valid, t, np.inf)
+    i = int(np.argmin(t))
+    return float(t[i]), float(u[i]), float(v[i]), i
+
+
+def intersectRays(
+    v0, edge1, edge2, starts, rays, eps=EPS, ignore=None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the nearest triangle hit for a batch of rays
+    Rays are processed in blocks so that at most BLOCK ray/triangle pairs are held in
+    memory
+    :param v0: (F, 3) first vertices
+    :param edge1: (F, 3) first edges
+    :param edge2: (F, 3) second edges
+    :param starts: (R, 3) ray starts (or a single start of shape (3,) shared by every
+        ray)
+    :param rays: (R, 3) ray directions
+    :param eps: tolerance for parallel rays and minimum t
+    :param ignore: optional (R,) index of a triangle to skip for each ray, -1 for none
+    :return: arrays (t, u, v, index) of length R, index is -1 (and t is inf) on a miss
+    """
+    rays = np.atleast_2d(np.asarray(rays, dtype=np.float64))
+    starts = np.broadcast_to(np.asarray(starts, dtype=np.float64), rays.shape)
+    if ignore is not None:
+        ignore = np.broadcast_to(np.asarray(ignore, dtype=np.int64), (len(rays),))
+    R = len(rays)
+    F = len(v0)
+    t_out = np.full(R, np.inf)
+    u_out = np.full(R, np.nan)
+    v_out = np.full(R, np.nan)
+    idx_out = np.full(R, -1, dtype=np.int64)
+    if F == 0 or R == 0:
+        return t_out, u_out, v_out, idx_out
+
+    step = max(1, BLOCK // F)
+    for b0 in range(0, R, step):
+        sl = slice(b0, min(b0 + step, R))
+        d = rays[sl, None, :]  # (B, 1, 3)
+        s = starts[sl, None, :]
+
+        pvec = _cross(d, edge2)  # (B, F, 3)
+        det = np.einsum("fj,bfj->bf", edge1, pvec)
+        valid = np.abs(det) >= eps
+        inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=valid)
+
+        tvec = s - v0  # (B, F, 3)
+        u = np.einsum("bfj,bfj->bf", tvec, pvec) * inv_det
+        valid &= (u >= 0.0) & (u <= 1.0)
+
+        qvec = _cross(tvec, edge1)
+        v = np.einsum("bfj,bfj->bf", qvec, np.broadcast_to(d, qvec.shape)) * inv_det
+        valid &= (v >= 0.0) & (u + v <= 1.0)
+
+        t = np.einsum("fj,bfj->bf", edge2, qvec) * inv_det
+        valid &= t >= eps
+        rows = np.arange(len(t))
+        if ignore is not None:
+            skip = ignore[sl]
+            mask = (skip >= 0) & (skip < F)
+            valid[rows[mask], skip[mask]] = False
+        t = np.where(valid, t, np.inf)
+
+        best = np.argmin(t, axis=1)
+        best_t = t[rows, best]
+        hit = np.isfinite(best_t)
+        t_out[sl] = best_t
+        u_out[sl] = np.where(hit, u[rows, best], np.nan)
+        v_out[sl] = np.where(hit, v[rows, best], np.nan)
+        idx_out[sl] = np.where(hit, best, -1)
+    return t_out, u_out, v_out, idx_out
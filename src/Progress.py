@@ -0,0 +1,180 @@
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+from tqdm import tqdm
+
+"""
+Progress counters shared by pool workers and the single reporter that shows them
+
+Every worker owns one row of a shared int64 array (rays traced, rays that hit anything,
+rays that hit critical geometry) and only ever adds to its own row, so no lock or
+message is needed. Rows are claimed when a worker starts (see claimRow), a worker the
+pool starts in place of one that died takes over its row. The reporter thread in the
+parent polls the array, shows the totals with rays/sec and ETA on one tqdm bar and can
+append the same numbers as JSON lines to a log file
+"""
+
+FIELDS = 3  # rays, hit_obj, hit_critical
+
+
+def progressCounters(processes: int):
+    """
+    :param processes: number of workers
+    :return: shared (processes * FIELDS) int64 array, zeroed
+    """
+    return mp.RawArray("q", processes * FIELDS)
+
+
+def progressRows(processes: int):
+    """
+    :param processes: number of workers
+    :return: shared array of the process id owning each row of the counters, 0 for a
+        free row
+    """
+    return mp.Array("q", processes)
+
+
+def claimRow(owners) -> int:
+    """
+    Take a free row, or the row of a worker that is gone, for the calling process
+    :param owners: array from progressRows
+    :return: row for addProgress
+    """
+    with owners.get_lock():
+        for row, pid in enumerate(owners):
+            if pid and _alive(pid):
+                continue
+            owners[row] = os.getpid()
+            return row
+    raise RuntimeError("every progress row is owned by a live worker")
+
+
+def _alive(pid: int) -> bool:
+    try:
+        # the pool reaps a dead worker before it starts the one taking its place
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def addProgress(counters, row: int, rays: int, hits: int, crits: int) -> None:
+    """
+    Add a block of rays to one worker's row (called by the worker that claimed it only)
+    """
+    row *= FIELDS
+    counters[row] += rays
+    counters[row + 1] += hits
+    counters[row + 2] += crits
+
+
+def readProgress(counters) -> list[tuple[int, int, int]]:
+    """
+    :return: (rays, hit_obj, hit_critical) of every worker
+    """
+    values = counters[:]
+    return [tuple(values[i : i + FIELDS]) for i in range(0, len(values), FIELDS)]
+
+
+class ProgressReporter:
+    """
+    Background thread showing the progress of one job
+
+        with ProgressReporter(counters, N, log="progress.jsonl") as progress:
+            ...
+            progress.postfix = "rel. err 0.01"
+    """
+
+    def __init__(self, counters, total: int, initial=0, interval=0.5, log=None):
+        """
+        :param counters: array from progressCounters, counts from before this job are
+            ignored
+        :param total: rays in the job
+        :param initial: rays already done (resumed run)
+        :param interval: seconds between updates
+        :param log: file to append a JSON line to on every update (default: None)
+        """
+        self.counters = counters
+        self.total = total
+        self.initial = initial
+        self.interval = interval
+        self.log = log
+        self.postfix = ""
+        self._base = readProgress(counters)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self) -> dict:
+        """
+        :return: progress of this job since the reporter started, per worker and in
+            total
+        """
+        now = readProgress(self.counters)
+        workers = [
+            [n - b for n, b in zip(row, base)] for row, base in zip(now, self._base)
+        ]
+        rays, hits, crits = (sum(column) for column in zip(*workers))
+        return {
+            "time": time.time(),
+            "rays": self.initial + rays,
+            "hit_obj": hits,
+            "hit_critical": crits,
+            "total": self.total,
+            "workers": [row[0] for row in workers],
+        }
+
+    def _run(self):
+        bar = tqdm(
+            total=self.total,
+            initial=self.initial,
+            leave=False,
+            colour="green",
+            ascii=True,
+        )
+        log = open(self.log, "a") if self.log else None
+        t0 = time.time()
+        start = self.initial
+        rate = 0.0
+        last = (t0, start)
+        while True:
+            stopping = self._stop.wait(self.interval)
+            sample = self.sample()
+            now, rays = sample["time"], sample["rays"]
+            if now > last[0]:
+                r = (rays - last[1]) / (now - last[0])
+                rate = r if rate == 0 else 0.7 * rate + 0.3 * r
+            last = (now, rays)
+            bar.update(min(rays, self.total) - bar.n)
+            bar.set_postfix_str(self.postfix, refresh=False)
+            if log:
+                sample["elapsed"] = now - t0
+                sample["rate"] = rate
+                sample["eta"] = (self.total - rays) / rate if rate > 0 else None
+                sample["postfix"] = self.postfix
+                log.write(json.dumps(sample) + "\n")
+                log.flush()
+            if stopping:
+                break
+        bar.close()
+        if log:
+            log.close()
+
+    def start(self) -> "ProgressReporter":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Take a last sample and close the bar and log
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,129 @@
+import gc
+import os
+import pickle
+from multiprocessing import shared_memory
+from TriangleMesh import TriangleMesh
+
+"""
+Publish a TriangleMesh to pool workers through shared memory
+
+The mesh (with its per triangle tables and any BVHs already built) is pickled with
+protocol 5, which hands every contiguous numpy array out of band. Those buffers are
+copied once into a single shared memory block and only the small remaining pickle and
+the block name travel to the workers, which rebuild the mesh on top of read only views
+of the block. Startup cost and resident memory of the mesh therefore do not grow with
+the number of workers
+
+The "numba" engine traverses these shared arrays directly. The "bvh" engine does not:
+BVH._toLists copies the BVH into Python lists in every worker (several times faster to
+index from Python than numpy arrays or memoryviews of the block, and about 5x their
+size), so with it each worker still holds a private copy of the BVH. TwobounceSession
+therefore defaults to the numba engine when it has more than one worker
+
+Only the owner (the process that created the SharedMesh) unlinks the block, see close()
+"""
+
+ALIGN = 64  # byte alignment of every array in the block
+# blocks whose views could not be released, kept so they are not closed again when
+# collected
+_unclosed = []
+
+
+class SharedMesh:
+    """
+    Handle to a TriangleMesh in shared memory, cheap to pickle, attach() rebuilds the
+    mesh in a worker
+    """
+
+    def __init__(self, mesh: TriangleMesh):
+        """
+        :param mesh: TriangleMesh to publish, build the BVHs the workers need before
+            sharing it
+        """
+        mesh.precompute()  # tables are dropped when pickled normally, send them along
+        buffers = []
+        self.payload = pickle.dumps(
+            (mesh, mesh._tables), protocol=5, buffer_callback=buffers.append
+        )
+        raw = [buffer.raw() for buffer in buffers]
+        self.layout = []
+        size = 0
+        for r in raw:
+            self.layout.append((size, r.nbytes))
+            size += -(-r.nbytes // ALIGN) * ALIGN
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for (offset, nbytes), r in zip(self.layout, raw):
+            self._shm.buf[offset : offset + nbytes] = r
+        self.name = self._shm.name
+        self.nbytes = size
+        # forked workers inherit this object, they must not unlink the block
+        self._owner = os.getpid()
+        self._views = []  # views of the block handed to the mesh by attach()
+        self._mesh = None
+
+    def __getstate__(self):
+        return {
+            "payload": self.payload,
+            "layout": self.layout,
+            "name": self.name,
+            "nbytes": self.nbytes,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = None
+        self._owner = None
+        self._views = []
+        self._mesh = None
+
+    def attach(self) -> TriangleMesh:
+        """
+        :return: the mesh, its arrays are read only views of the shared block (kept open
+            while self lives)
+        """
+        if self._mesh is None:
+            if self._shm is None:
+                self._shm = shared_memory.SharedMemory(name=self.name)
+            buf = self._shm.buf.toreadonly()
+            self._views = [
+                buf[offset : offset + nbytes] for offset, nbytes in self.layout
+            ]
+            mesh, tables = pickle.loads(self.payload, buffers=self._views)
+            self._views.append(buf)
+            mesh._tables = tables
+            self._mesh = mesh
+        return self._mesh
+
+    def close(self) -> None:
+        """
+        Release the block, the owner also unlinks it (workers must be done with it by
+        then)
+        Meshes returned by attach() must be dropped first, their arrays still point into
+        the block. If an array is still referenced (e.g. by a worker that died mid-task)
+        the block stays mapped until the process exits
+        """
+        if self._mesh is not None:
+            self._mesh = None
+            # BVHs reference themselves through their bound leaf test, free them with
+            # the mesh
+            gc.collect()
+        if self._shm is not None:
+            if self._owner == os.getpid():
+                self._shm.unlink()
+            try:
+                for view in self._views:
+                    view.release()
+                self._shm.close()
+            except BufferError:
+                _unclosed.append(self._shm)
+            self._shm = None
+            self._views = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f"[SharedMesh: {self.name}, {self.nbytes / 2**20:.1f} MiB]"
@@ -1,11 +1,26 @@
-from collections import defaultdict
+import functools
+import multiprocessing as mp
 import os
 
 from PIL import Image
 import numpy as np
-from twobounce2 import print, printf
+from twobounce2 import (
+    TEXTURE_FILE,
+    addTextureCounts,
+    binTextureHits,
+    loadTextures,
+    print,
+    printf,
+)
+from HitRecords import readRecordBlocks
 
 N = 200  # size of images
+BLOCK = 1 << 18  # hits read from an output file at once
+LINE_CHARS = 48  # rough characters per line of a text output file, sizes its blocks
+# colours of the density heatmaps, from the fewest to the most hits
+HEAT = np.array(
+    [[255, 255, 178], [254, 204, 92], [253, 141, 60], [240, 59, 32], [189, 0, 38]]
+)
 
 
 def stripMaterialInformation(lines):  # strip any preexisting material information
@@ -44,61 +59,168 @@ def writeNewObj(OUT_LOCATION, FILENAME, newFile):
         f.write(newFile)
 
 
-class hit:
-    def __init__(self, name, hit_num, coords) -> None:
-        self.name = name
-        self.hit_num = hit_num
-        self.x, self.y = coords
+def _parseHitText(text):
+    """
+    :param text: whole lines of a text hit file
+    :return: (object index, bounce, texture u, texture v, object names), see
+        readHitBlocks
+    """
+    fields = text.replace(",", "\t").replace("\n", "\t").split("\t")[:-1]
+    index = {}  # object name -> object index
+    objects = np.array(
+        [index.setdefault(name, len(index)) for name in fields[0::4]], dtype=np.int64
+    )
+    n = len(objects)
+    return (
+        objects,
+        np.fromiter(map(int, fields[1::4]), np.int64, n),
+        np.fromiter(map(float, fields[2::4]), np.float64, n),
+        np.fromiter(map(float, fields[3::4]), np.float64, n),
+        list(index),
+    )
 
-    def __repr__(self) -> str:
-        return f"{self.name} - {self.hit_num}: <{self.x}, {self.y}>"
 
+def readHitBlocks(filename, block=BLOCK):
+    """
+    Read one output file a block at a time, so only one block of hits is in memory
+    :param filename: binary hit file (.bin, see HitRecords) or text hit file (.txt, see
+        twobounce2.writeHits)
+    :param block: hits per block (text files are read in blocks of about as many lines)
+    :return: generator of (object index, bounce, texture u, texture v, object names),
+        one array entry per hit
+    """
+    if filename.endswith(".bin"):
+        for r, names in readRecordBlocks(filename, block):
+            yield r["object"], r["bounce"], r["tex_u"], r["tex_v"], names
+        return
+    with open(filename, "r") as f:
+        rest = ""  # partial last line of the previous block
+        while True:
+            text = f.read(block * LINE_CHARS)
+            if not text:
+                break
+            text = rest + text
+            end = text.rfind("\n") + 1
+            rest = text[end:]
+            yield _parseHitText(text[:end])
+    if rest:
+        yield _parseHitText(rest + "\n")
 
-def parser():
-    lines = 0
-    hits = defaultdict(list)
 
-    for filename in os.listdir("./output"):
-        print(f"Parsing {filename}")
-        with open("./output/" + filename, "r") as f:
-            lines = f.readlines()
-        for line in lines:
-            line = line.strip()
-            split = line.split("\t")
-            name = split[0]
-            hit_num = int(split[1])
-            coords = [float(n) for n in split[2].split(",")]
-            hits[name].append(hit(name, hit_num, coords))
-        # print(fs)
-    return hits
+def fileCounts(filename, size=N, block=BLOCK) -> dict:
+    """
+    Fold the hits of one output file into per object counts, one block at a time (memory
+    grows with the block and the objects hit, not with the number of objects)
+    :param filename: binary or text hit file
+    :param size: pixels per side
+    :param block: hits per block
+    :return: object name -> (2, size, size) hit counts, indexed [bounce, row, column]
+    """
+    print(f"Parsing {filename}")
+    counts = {}
+    for objects, bounce, x, y, names in readHitBlocks(filename, block):
+        addTextureCounts(
+            counts, *binTextureHits(objects, bounce, x, y, size), size, names
+        )
+    return counts
 
 
-def writeImages():
-    images = {}
+def hitCounts(folder="./output", size=N, processes=1):
+    """
+    Count the hits in every output file per object, bounce and image pixel
+    Files are streamed in blocks (see fileCounts), with processes > 1 several files are
+    counted at once and the counts summed at the end
+    :param folder: folder with the output files of a "full" run
+    :param size: pixels per side
+    :param processes: files counted in parallel
+    :return: ((objects, 2, size, size) hit counts, object names)
+    """
+    files = [
+        os.path.join(folder, filename)
+        for filename in sorted(os.listdir(folder))
+        if filename.endswith((".txt", ".bin"))
+    ]
+    if processes > 1 and len(files) > 1:
+        with mp.Pool(min(processes, len(files))) as pool:
+            partials = pool.imap_unordered(
+                functools.partial(fileCounts, size=size), files
+            )
+            counts = functools.reduce(_addCounts, partials, {})
+    else:
+        counts = functools.reduce(
+            _addCounts, (fileCounts(filename, size) for filename in files), {}
+        )
+    names = sorted(counts)
+    return np.array([counts[key] for key in names]).reshape(-1, 2, size, size), names
+
+
+def _addCounts(total: dict, counts: dict) -> dict:
+    for key, c in counts.items():
+        total[key] = total.get(key, 0) + c
+    return total
+
+
+def presenceImage(first, second):
+    """
+    :param first: (size, size) counts of first hits
+    :param second: (size, size) counts of hits after the reflection
+    :return: (size, size, 3) image, red where a ray first hit, green where only
+        reflected rays hit, else white
+    """
+    image = np.full(first.shape + (3,), 255, dtype=np.uint8)
+    image[second > 0] = [0, 255, 0]
+    image[first > 0] = [255, 0, 0]
+    return image
+
+
+def heatmapImage(counts):
+    """
+    :param counts: (size, size) hit counts
+    :return: (size, size, 3) image, white without hits, yellow to dark red by
+        log(1 + hits)
+    """
+    image = np.full(counts.shape + (3,), 255, dtype=np.uint8)
+    hit = counts > 0
+    if hit.any():
+        level = np.log1p(counts[hit]) / np.log1p(counts.max())
+        stops = np.linspace(0, 1, len(HEAT))
+        image[hit] = np.stack(
+            [np.interp(level, stops, HEAT[:, c]) for c in range(3)], axis=1
+        )
+    return image
+
+
+def writeTextureImages(counts, object_names):
+    """
+    Write the images of every object with hits: mat_<name>.png (presence of first and
+    reflected hits, the texture used by the .mtl) and density_<name>.png (heatmap of all
+    hits)
+    :param counts: (objects, 2, size, size) hit counts, see twobounce2.textureCounts
+    :param object_names: names of the objects, in the order of counts
+    """
     print("Writing images")
-    data = parser()
-    print(data.keys())
-    for i, key in enumerate(data):
-        print(f"Writing image for {key} ({i+1}/{len(data)})")
-        hits = data[key]
-        image = np.zeros((N, N, 3), dtype=np.uint8)
-        image.fill(255)
-
-        for hit in hits:
-            x = int(N * hit.x)
-            y = int((N) - N * hit.y)
-            if hit.hit_num == 0:
-                image[y][x] = [255, 0, 0]
-            elif hit.hit_num == 1:
-                if not np.array_equal(image[y][x], [255, 0, 0]):
-                    image[y][x] = [0, 255, 0]
-        images[key] = Image.fromarray(image)
-
-    for key in images:
-        images[key].save(f"./Textured/images/mat_{key}.png")
-
-
-def main(FILENAME):
+    for key, (first, second) in zip(object_names, counts):
+        if not first.any() and not second.any():
+            continue
+        Image.fromarray(presenceImage(first, second)).save(
+            f"./Textured/images/mat_{key}.png"
+        )
+        Image.fromarray(heatmapImage(first + second)).save(
+            f"./Textured/images/density_{key}.png"
+        )
+
+
+def writeImages(processes=1):
+    """
+    :param processes: output files counted in parallel, see hitCounts
+    """
+    if os.path.exists(TEXTURE_FILE):  # counts of a "texture" run, no hits to parse
+        writeTextureImages(*loadTextures(TEXTURE_FILE))
+    else:
+        writeTextureImages(*hitCounts(processes=processes))
+
+
+def main(FILENAME, processes=1):
     LOCATION = "./"
     OUT_LOCATION = "./Textured/"
     # FILENAME = "ReflectionTestWIthCube"
@@ -135,4 +257,4 @@ def main(FILENAME):
     printf("Objs", objects)
     writeNewMtl(OUT_LOCATION, MTL_FILE_NAME, objects)
     writeNewObj(OUT_LOCATION, FILENAME, newFile)
-    writeImages()
+    writeImages(processes)
@@ -0,0 +1,763 @@
+import hashlib
+import os
+import warnings
+import numpy as np
+from GeometricObjects import Vector, Triangle, TriObject
+
+CACHE_VERSION = 2  # bump when the parser changes, older cache files are then rebuilt
+OBJ_BLOCK = 1 << 22  # bytes of an .obj file parsed at once
+CACHE_ARRAYS = [
+    "vertices",
+    "faces",
+    "normals",
+    "uvs",
+    "object_ids",
+    "object_names",
+    "object_critical",
+]
+
+
+def cachePath(filename: str) -> str:
+    """
+    :param filename: path to .obj file
+    :return: path of its mesh cache, <name>.mesh.npz in the same folder
+    """
+    return os.path.splitext(filename)[0] + ".mesh.npz"
+
+
+def _readCache(filename: str):
+    """
+    :return: {"version", "size", "mtime", "sha256", "mesh": TriangleMesh arguments} or
+        None if there is no readable cache (missing, empty, truncated or otherwise
+        broken files are parsed again)
+    """
+    try:
+        with np.load(filename) as data:
+            cached = {k: data[k].item() for k in ["version", "size", "mtime", "sha256"]}
+            cached["mesh"] = [
+                data[k].tolist() if k == "object_names" else data[k]
+                for k in CACHE_ARRAYS
+            ]
+    except Exception:
+        # OSError, EOFError, zipfile.BadZipFile, KeyError, ValueError, ...
+        return None
+    return cached
+
+
+def _writeCache(filename: str, key: dict, args) -> None:
+    """
+    Write the cache atomically (other processes may be loading or writing the same
+    file): to a temporary file of this process that then replaces filename, so the cache
+    is never seen half written. Skipped if the folder is not writable
+    :param key: version, size, mtime and sha256 of the .obj file
+    :param args: TriangleMesh arguments parsed from it
+    """
+    arrays = dict(zip(CACHE_ARRAYS, args))
+    arrays["object_names"] = np.array(arrays["object_names"], dtype=str)
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays, **key)
+        os.replace(tmp, filename)
+    except OSError:
+        pass
+    finally:  # left behind by a failed or interrupted write
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class _GrowingArray:
+    """
+    Rows appended block by block to a preallocated array whose capacity doubles when it
+    is full, so appending n rows costs O(n) in total and the array never holds more than
+    twice the rows it needs
+    """
+
+    def __init__(self, shape=(), dtype=np.float64, capacity=1 << 12):
+        self.data = np.empty((capacity, *shape), dtype=dtype)
+        self.size = 0
+
+    def extend(self, rows) -> None:
+        n = self.size + len(rows)
+        if n > len(self.data):
+            self.data.resize(
+                (max(n, 2 * len(self.data)), *self.data.shape[1:]), refcheck=False
+            )
+        self.data[self.size : n] = rows
+        self.size = n
+
+    def array(self) -> np.ndarray:
+        """
+        :return: the rows, the spare capacity is released (do not extend afterwards)
+        """
+        self.data.resize((self.size, *self.data.shape[1:]), refcheck=False)
+        return self.data
+
+
+class ObjIngester:
+    """
+    Streaming .obj parser: feed() takes the file in blocks and appends what their lines
+    hold to packed arrays, so memory stays close to the size of the finished
+    TriangleMesh and time is linear in the file size
+
+    Within a block lines are classified by their first bytes with numpy and each kind of
+    line is converted with one numpy call. Faces may have any number of corners, in the
+    v, v/vt, v//vn or v/vt/vn form and with negative (relative) indices, polygons are
+    split into triangle fans. Triangles of faces without texture coordinates get
+    DEFAULT_UVS, triangles of faces without normals get their own unit normal
+
+        ingester = ObjIngester()
+        for data in blocks:
+            ingester.feed(data)
+        mesh = TriangleMesh(*ingester.finish())
+    """
+
+    # texture coordinate = barycentric coordinate
+    DEFAULT_UVS = ((0.0, 0.0), (1.0, 0.0), (0.0, 1.0))
+
+    def __init__(self):
+        self.vertices = _GrowingArray((3,))
+        self.texture_verticies = _GrowingArray((2,))
+        self.vertex_normals = _GrowingArray((3,))
+        self.face_v = _GrowingArray((3,), np.int64)
+        # -1 if the face has no texture coordinates
+        self.face_vt = _GrowingArray((3,), np.int64)
+        self.face_vn = _GrowingArray((), np.int64)  # -1 if the face has no normals
+        self.object_ids = _GrowingArray((), np.int32)
+        self.object_names = []
+        self._rest = b""  # unfinished last line of the previous block
+
+    def feed(self, data: bytes) -> None:
+        """
+        :param data: next bytes of the file, blocks may end anywhere
+        """
+        data = self._rest + data
+        cut = data.rfind(b"\n") + 1
+        self._rest = data[cut:]
+        if cut:
+            self._parseBlock(data[:cut])
+
+    def finish(self) -> tuple:
+        """
+        :return: TriangleMesh arguments
+        """
+        if self._rest.strip():
+            self._parseBlock(self._rest + b"\n")
+        self._rest = b""
+        vertices = self.vertices.array()
+        faces = self.face_v.array()
+        face_vt = self.face_vt.array()
+        face_vn = self.face_vn.array()
+        for kind, idx, low, count in [
+            ("vertex", faces, 0, len(vertices)),
+            ("texture coordinate", face_vt, -1, self.texture_verticies.size),
+            ("normal", face_vn, -1, self.vertex_normals.size),
+        ]:
+            if len(idx) and (idx.min() < low or idx.max() >= count):
+                raise ValueError(f"face {kind} index out of range")
+
+        vertex_normals = self.vertex_normals.array()
+        if len(vertex_normals):
+            normals = vertex_normals[np.maximum(face_vn, 0)]
+        else:
+            normals = np.zeros((len(faces), 3))
+        missing = np.flatnonzero(face_vn < 0)
+        for b0 in range(0, len(missing), 1 << 18):  # in blocks, temporaries stay small
+            ids = missing[b0 : b0 + (1 << 18)]
+            tri = vertices[faces[ids]]
+            n = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+            length = np.linalg.norm(n, axis=1, keepdims=True)
+            normals[ids] = np.divide(n, length, out=np.zeros_like(n), where=length > 0)
+
+        texture_verticies = self.texture_verticies.array()
+        if len(texture_verticies):
+            uvs = texture_verticies[np.maximum(face_vt, 0)]
+        else:
+            uvs = np.zeros((len(faces), 3, 2))
+        uvs[face_vt[:, 0] < 0] = self.DEFAULT_UVS
+        return (
+            vertices,
+            faces,
+            normals,
+            uvs,
+            self.object_ids.array(),
+            self.object_names,
+            ["crit" in name.split("-") for name in self.object_names],
+        )
+
+    def _parseBlock(self, data: bytes) -> None:
+        """
+        :param data: whole lines, ending with a newline
+        """
+        # padded so every line has three bytes
+        buf = np.frombuffer(data + b"  ", dtype=np.uint8).copy()
+        ends = np.flatnonzero(buf == ord("\n"))
+        starts = np.concatenate([[0], ends[:-1] + 1])
+        # indented lines
+        if np.any((buf[starts] == ord(" ")) | (buf[starts] == ord("\t"))):
+            data = b"\n".join(line.lstrip() for line in data.split(b"\n"))
+            buf = np.frombuffer(data + b"  ", dtype=np.uint8).copy()
+            ends = np.flatnonzero(buf == ord("\n"))
+            starts = np.concatenate([[0], ends[:-1] + 1])
+        b0, b1, b2 = buf[starts], buf[starts + 1], buf[starts + 2]
+        blank1 = (b1 == ord(" ")) | (b1 == ord("\t"))
+        blank2 = (b2 == ord(" ")) | (b2 == ord("\t"))
+        kinds = {
+            "v": (b0 == ord("v")) & blank1,
+            "vt": (b0 == ord("v")) & (b1 == ord("t")) & blank2,
+            "vn": (b0 == ord("v")) & (b1 == ord("n")) & blank2,
+            "f": (b0 == ord("f")) & blank1,
+        }
+        objects = np.flatnonzero(((b0 == ord("o")) | (b0 == ord("g"))) & blank1)
+        names = [
+            (data[starts[i] + 2 : ends[i]].decode().split() or ["default"])[0]
+            for i in objects
+        ]
+
+        # numbers and slashes per line, keys and slashes are blanked so only numbers are
+        # left
+        slashes = _perLine(buf == ord("/"), starts)
+        for key, mask in kinds.items():
+            for i in range(len(key)):
+                buf[starts[mask] + i] = ord(" ")
+        buf[buf == ord("/")] = ord(" ")
+        filled = buf > ord(" ")
+        numbers = _perLine(filled & ~np.concatenate([[False], filled[:-1]]), starts)
+
+        for key, target, width in [
+            ("v", self.vertices, 3),
+            ("vt", self.texture_verticies, 2),
+            ("vn", self.vertex_normals, 3),
+        ]:
+            counts = numbers[kinds[key]]
+            values = _numbers(buf, starts, ends, kinds[key], counts, np.float64)
+            offsets = np.cumsum(counts) - counts
+            column = np.arange(width)
+            rows = np.zeros((len(counts), width))
+            # missing trailing numbers are 0 ("vt u")
+            present = column < counts[:, None]
+            rows[present] = values[(offsets[:, None] + column)[present]]
+            target.extend(rows)
+
+        f_lines = np.flatnonzero(kinds["f"])
+        if len(f_lines) == 0:
+            self.object_names += names
+            return
+        if not self.object_names and (len(objects) == 0 or objects[0] > f_lines[0]):
+            self.object_names.append("default")  # faces before any object line
+        current = len(self.object_names) - 1
+        self.object_names += names
+        triangles = self._parseFaces(
+            buf, starts, ends, kinds, f_lines, numbers[f_lines], slashes[f_lines]
+        )
+        ids = current + np.searchsorted(objects, f_lines)
+        self.object_ids.extend(np.repeat(ids, triangles).astype(np.int32))
+
+    def _parseFaces(
+        self, buf, starts, ends, kinds, f_lines, numbers, slashes
+    ) -> np.ndarray:
+        """
+        Triangulate the face lines of a block, called after its v, vt and vn lines were
+        added
+        :return: number of triangles of each face line
+        """
+        # numbers per corner from the numbers and slashes of the line: v, v/vt, v/vt/vn
+        # or v//vn
+        forms = [
+            slashes == 0,
+            numbers == 2 * slashes,
+            2 * numbers == 3 * slashes,
+            numbers == slashes,
+        ]
+        k = np.select(forms, [1, 2, 3, 2], 0)
+        if np.any(k == 0):
+            i = f_lines[np.argmax(k == 0)]
+            text = bytes(buf[starts[i] : ends[i]]).decode().strip()
+            raise ValueError(f"unsupported face line {text!r}")
+        has_vt = (slashes > 0) & (numbers != slashes)
+        has_vn = (slashes > 0) & (numbers != 2 * slashes)
+        corners = numbers // k
+        values = _numbers(buf, starts, ends, kinds["f"], numbers, np.int64)
+        offsets = np.cumsum(numbers) - numbers
+
+        # fan triangle i of a polygon uses its corners 0, i + 1, i + 2
+        triangles = np.maximum(corners - 2, 0)
+        line = np.repeat(np.arange(len(f_lines)), triangles)
+        fan = np.arange(len(line)) - np.repeat(
+            np.cumsum(triangles) - triangles, triangles
+        )
+        corner = np.stack([np.zeros_like(fan), fan + 1, fan + 2], axis=1)
+        # first number of every corner
+        first = offsets[line][:, None] + corner * k[line][:, None]
+
+        # vertices defined before each face line, relative indices count back from there
+        counts = {
+            key: np.cumsum(kinds[key])[f_lines][line] for key in ["v", "vt", "vn"]
+        }
+        targets = {
+            "v": self.vertices,
+            "vt": self.texture_verticies,
+            "vn": self.vertex_normals,
+        }
+        for key, target in targets.items():
+            counts[key] += target.size - np.count_nonzero(kinds[key])
+
+        def resolve(idx, count):
+            return np.where(idx < 0, idx + count, idx - 1)
+
+        self.face_v.extend(resolve(values[first], counts["v"][:, None]))
+        vt = resolve(values[first + has_vt[line][:, None]], counts["vt"][:, None])
+        self.face_vt.extend(np.where(has_vt[line][:, None], vt, -1))
+        vn = resolve(values[first[:, 0] + (k[line] - 1) * has_vn[line]], counts["vn"])
+        self.face_vn.extend(np.where(has_vn[line], vn, -1))
+        return triangles
+
+
+def _perLine(flags, starts) -> np.ndarray:
+    """
+    :param flags: bool per byte of a block
+    :param starts: first byte of every line
+    :return: number of flagged bytes on every line
+    """
+    return np.diff(
+        np.searchsorted(np.flatnonzero(flags), np.append(starts, len(flags)))
+    )
+
+
+def _numbers(buf, starts, ends, mask, counts, dtype) -> np.ndarray:
+    """
+    Convert all numbers of the lines selected by mask
+    :param buf: uint8 block with the line keys and slashes blanked
+    :param starts: first byte of every line
+    :param ends: newline of every line
+    :param mask: lines to convert
+    :param counts: numbers on each of those lines
+    :return: flat array of the numbers, line after line
+    """
+    if not np.any(mask):
+        return np.zeros(0, dtype=dtype)
+    # runs of consecutive selected lines are contiguous in buf
+    first = np.flatnonzero(mask & ~np.concatenate([[False], mask[:-1]]))
+    last = np.flatnonzero(mask & ~np.concatenate([mask[1:], [False]]))
+    text = b"".join(buf[starts[i] : ends[j] + 1].tobytes() for i, j in zip(first, last))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            values = np.fromstring(text, dtype=dtype, sep=" ")
+    except ValueError:  # raised instead of the warning by newer numpy
+        values = None
+    if values is None or len(values) != counts.sum():
+        raise ValueError(
+            "malformed .obj line, expected only numbers after v, vt, vn and f"
+        )
+    return values
+
+
+def _hashFile(filename: str, block=OBJ_BLOCK) -> str:
+    """
+    :return: sha256 hex digest of the file
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                return h.hexdigest()
+            h.update(data)
+
+
+def _readObj(filename: str, block=OBJ_BLOCK) -> tuple:
+    """
+    Stream an .obj file through an ObjIngester, hashing it on the way
+    :return: (TriangleMesh arguments, sha256 hex digest of the file)
+    """
+    ingester = ObjIngester()
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            h.update(data)
+            ingester.feed(data)
+    return ingester.finish(), h.hexdigest()
+
+
+class TriangleMesh:
+    """
+    Structure-of-arrays container for a whole scene
+
+    vertices        - (V, 3) float64 vertex positions
+    faces           - (F, 3) int64 indices into vertices
+    normals         - (F, 3) float64 per face normal
+    uvs             - (F, 3, 2) float64 per face texture coordinates of each corner
+    object_ids      - (F,) int32 index of the object each face belongs to
+    critical        - (F,) bool, True if the face belongs to critical geometry
+    object_names    - list of object names
+    object_critical - (O,) bool per object critical flag
+    object_start    - (O,) first face of each object, faces of an object are always
+                      contiguous
+    object_end      - (O,) one past the last face of each object
+    object_min      - (O, 3) minimum corner of each object's bounding box
+    object_max      - (O, 3) maximum corner of each object's bounding box
+    bounds          - (2, 3) minimum and maximum corner of the whole scene
+
+    Per triangle tables (see precompute) are built on first use:
+    v0, edge1, edge2 - (F, 3) first vertex and the edges to the second and third vertex
+    unit_normals     - (F, 3) normals scaled to length 1 (0 for a zero normal), used for
+                       reflections
+    uv_affine        - (F, 3, 2) texture coordinate map,
+                       texture coordinate = uv_affine[f].T @ (1, u, v)
+    transforms       - (F, 3, 4) Baldwin-Weber ray transforms (see
+                       Intersections.transformTriangles),
+                       only built on request, the BVHs then test rays with them
+
+    TriObject / Triangle views are only built when .objects or .triangles is first
+    accessed
+    """
+
+    def __init__(
+        self,
+        vertices,
+        faces,
+        normals,
+        uvs,
+        object_ids,
+        object_names: list[str],
+        object_critical,
+    ):
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float64).reshape(-1, 3)
+        self.faces = np.ascontiguousarray(faces, dtype=np.int64).reshape(-1, 3)
+        self.normals = np.ascontiguousarray(normals, dtype=np.float64).reshape(-1, 3)
+        self.uvs = np.ascontiguousarray(uvs, dtype=np.float64).reshape(-1, 3, 2)
+        self.object_ids = np.ascontiguousarray(object_ids, dtype=np.int32)
+        self.object_names = list(object_names)
+        self.object_critical = np.asarray(object_critical, dtype=bool)
+        if np.any(np.diff(self.object_ids) < 0):  # group faces by object
+            order = np.argsort(self.object_ids, kind="stable")
+            self.faces = self.faces[order]
+            self.normals = self.normals[order]
+            self.uvs = self.uvs[order]
+            self.object_ids = self.object_ids[order]
+        self.critical = self.object_critical[self.object_ids]
+        self._calcBounds()
+        self.ray_transform = False  # BVHs test rays with the transforms, see precompute
+        self._tables = None
+        self._bvh = None
+        self._critical_bvh = None
+        self._other_bvh = None
+        self._objects = None
+        self._triangles = None
+
+    @classmethod
+    def fromObj(cls, filename: str, cache=True) -> "TriangleMesh":
+        """
+        Load an .obj file, streamed through an ObjIngester (polygons are triangulated,
+        missing normals and texture coordinates filled in)
+        Objects start at "o" or "g" lines, objects with "crit" in their "-" separated
+        name are critical
+        The parsed arrays are cached in <name>.mesh.npz next to the file (see
+        cachePath). The cache is used while the file's size and mtime are unchanged, or
+        its content hash still matches after a touch
+        :param filename: path to .obj file
+        :param cache: read and write the cache file (default: True)
+        :return: TriangleMesh
+        """
+        stat = os.stat(filename)
+        key = {
+            "version": CACHE_VERSION,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+        }
+        cached = _readCache(cachePath(filename)) if cache else None
+        if cached is not None and all(cached[k] == v for k, v in key.items()):
+            return cls(*cached["mesh"])
+        fresh = cached is not None and cached["version"] == CACHE_VERSION
+        if fresh and cached["sha256"] == _hashFile(filename):  # touched but unchanged
+            key["sha256"] = cached["sha256"]
+            args = cached["mesh"]
+        else:
+            args, key["sha256"] = _readObj(filename)
+        if cache:
+            _writeCache(cachePath(filename), key, args)
+        return cls(*args)
+
+    @classmethod
+    def fromObjects(cls, objects: list[TriObject]) -> "TriangleMesh":
+        """
+        Pack existing TriObjects, the objects themselves are kept as the views of the
+        new mesh
+        :param objects: list of TriObjects
+        :return: TriangleMesh
+        """
+        triangles = [tri for obj in objects for tri in obj.triangles]
+        coords = np.array(
+            [[tri.a.arr, tri.b.arr, tri.c.arr] for tri in triangles], dtype=np.float64
+        )
+        mesh = cls(
+            coords.reshape(-1, 3),
+            np.arange(3 * len(triangles)).reshape(-1, 3),
+            [tri.normal.arr for tri in triangles],
+            [tri.textureCoords for tri in triangles],
+            [i for i, obj in enumerate(objects) for _ in obj.triangles],
+            [obj.name for obj in objects],
+            [obj.critial for obj in objects],
+        )
+        for i, tri in enumerate(triangles):
+            tri.id = i
+        for i, obj in enumerate(objects):
+            obj.id = i
+            obj.bounding_box = [
+                Vector(*mesh.object_min[i]),
+                Vector(*mesh.object_max[i]),
+            ]
+        mesh._objects = list(objects)
+        mesh._triangles = triangles
+        return mesh
+
+    def __len__(self):
+        return len(self.faces)
+
+    def _calcBounds(self):
+        O = len(self.object_names)
+        self.object_start = np.searchsorted(self.object_ids, np.arange(O), side="left")
+        self.object_end = np.searchsorted(self.object_ids, np.arange(O), side="right")
+        self.object_min = np.full((O, 3), np.inf)
+        self.object_max = np.full((O, 3), -np.inf)
+        for i, (start, end) in enumerate(zip(self.object_start, self.object_end)):
+            if end > start:
+                # one corner at a time, a copy of every face's points would be 3x the
+                # mesh
+                for corner in range(3):
+                    pts = self.vertices[self.faces[start:end, corner]]
+                    self.object_min[i] = np.minimum(self.object_min[i], pts.min(axis=0))
+                    self.object_max[i] = np.maximum(self.object_max[i], pts.max(axis=0))
+        if len(self.faces):
+            self.bounds = np.array(
+                [self.object_min.min(axis=0), self.object_max.max(axis=0)]
+            )
+        else:
+            self.bounds = np.array([[np.inf] * 3, [-np.inf] * 3])
+
+    def digest(self) -> str:
+        """
+        :return: sha256 hex digest of the geometry (vertices, faces, normals, uvs and
+            objects), equal for meshes that trace identically, used to check that every
+            machine of a run loaded the same scene
+        """
+        h = hashlib.sha256()
+        for arr in [
+            self.vertices,
+            self.faces,
+            self.normals,
+            self.uvs,
+            self.object_ids,
+            self.object_critical,
+        ]:
+            h.update(str(arr.shape).encode())
+            h.update(np.ascontiguousarray(arr).tobytes())
+        h.update("\n".join(self.object_names).encode())
+        return h.hexdigest()
+
+    def __getstate__(self):
+        # views and derived arrays are rebuilt on demand, do not send them to pool
+        # workers
+        state = self.__dict__.copy()
+        state["_tables"] = None
+        state["_objects"] = None
+        state["_triangles"] = None
+        return state
+
+    def precompute(self, transform=False) -> "TriangleMesh":
+        """
+        Build the per triangle tables, constants of a static mesh that the engines read
+        instead of recomputing them for every ray (prepareMesh calls this before the
+        mesh is shared with workers)
+        :param transform: also build the ray transforms and have the BVHs test rays with
+            them
+        :return: self
+        """
+        if self._tables is None:
+            tri = self.vertices[self.faces]
+            length = np.linalg.norm(self.normals, axis=1, keepdims=True)
+            unit = np.divide(
+                self.normals, length, out=np.zeros_like(self.normals), where=length > 0
+            )
+            uvs = self.uvs
+            self._tables = {
+                "v0": np.ascontiguousarray(tri[:, 0]),
+                "edge1": np.ascontiguousarray(tri[:, 1] - tri[:, 0]),
+                "edge2": np.ascontiguousarray(tri[:, 2] - tri[:, 0]),
+                "unit_normals": unit,
+                "uv_affine": np.stack(
+                    [uvs[:, 0], uvs[:, 1] - uvs[:, 0], uvs[:, 2] - uvs[:, 0]], axis=1
+                ),
+            }
+        if transform and not self.ray_transform:
+            self.ray_transform = True
+            for bvh in [self._bvh, self._critical_bvh, self._other_bvh]:
+                if bvh is not None:
+                    bvh.useTransforms(self.transforms)
+        return self
+
+    @property
+    def v0(self) -> np.ndarray:
+        """
+        :return: (F, 3) first vertex of every face
+        """
+        return self.precompute()._tables["v0"]
+
+    @property
+    def edge1(self) -> np.ndarray:
+        """
+        :return: (F, 3) second minus first vertex of every face
+        """
+        return self.precompute()._tables["edge1"]
+
+    @property
+    def edge2(self) -> np.ndarray:
+        """
+        :return: (F, 3) third minus first vertex of every face
+        """
+        return self.precompute()._tables["edge2"]
+
+    @property
+    def unit_normals(self) -> np.ndarray:
+        """
+        :return: (F, 3) face normals of length 1, 0 for faces without a normal
+        """
+        return self.precompute()._tables["unit_normals"]
+
+    @property
+    def uv_affine(self) -> np.ndarray:
+        """
+        :return: (F, 3, 2) texture coordinate of the first vertex and its change along u
+            and along v
+        """
+        return self.precompute()._tables["uv_affine"]
+
+    @property
+    def transforms(self) -> np.ndarray:
+        """
+        :return: (F, 3, 4) ray transforms of every face (see
+            Intersections.transformTriangles), built on first access
+        """
+        tables = self.precompute()._tables
+        if "transforms" not in tables:
+            from Intersections import transformTriangles
+
+            tables["transforms"] = transformTriangles(self.v0, self.edge1, self.edge2)
+        return tables["transforms"]
+
+    def textureCoordinates(self, faces, us, vs) -> np.ndarray:
+        """
+        :param faces: (n,) face of each hit
+        :param us: (n,) u of each hit
+        :param vs: (n,) v of each hit
+        :return: (n, 2) texture coordinates of the hits
+        """
+        a = self.uv_affine[faces]
+        return (
+            a[:, 0]
+            + np.asarray(us)[:, None] * a[:, 1]
+            + np.asarray(vs)[:, None] * a[:, 2]
+        )
+
+    def _newBvh(self, ids=None):
+        from BVH import BVH
+
+        if ids is None:
+            bvh = BVH(self.v0, self.edge1, self.edge2)
+        else:
+            bvh = BVH(self.v0[ids], self.edge1[ids], self.edge2[ids], ids=ids)
+        if self.ray_transform:
+            bvh.useTransforms(self.transforms)
+        return bvh
+
+    @property
+    def bvh(self):
+        """
+        :return: SAH BVH over all faces, built on first access (and sent along with the
+            mesh to workers)
+        """
+        if self._bvh is None:
+            self._bvh = self._newBvh()
+        return self._bvh
+
+    def _subsetBvh(self, mask):
+        return self._newBvh(np.nonzero(mask)[0])
+
+    @property
+    def critical_bvh(self):
+        """
+        :return: BVH over the critical faces only (reports mesh face indices), built on
+            first access
+        """
+        if self._critical_bvh is None:
+            self._critical_bvh = self._subsetBvh(self.critical)
+        return self._critical_bvh
+
+    @property
+    def other_bvh(self):
+        """
+        :return: BVH over the non critical faces only (reports mesh face indices), built
+            on first access
+        """
+        if self._other_bvh is None:
+            self._other_bvh = self._subsetBvh(~self.critical)
+        return self._other_bvh
+
+    @property
+    def objects(self) -> list[TriObject]:
+        """
+        :return: list of TriObject views, built on first access
+        """
+        if self._objects is None:
+            self._buildViews()
+        return self._objects
+
+    @property
+    def triangles(self) -> list[Triangle]:
+        """
+        :return: list of Triangle views (index i is face i), built on first access
+        """
+        if self._triangles is None:
+            self._buildViews()
+        return self._triangles
+
+    def _buildViews(self):
+        points = [Vector(*p) for p in self.vertices.tolist()]
+        objects = [
+            TriObject(name, [], [], bool(crit))
+            for name, crit in zip(self.object_names, self.object_critical)
+        ]
+        triangles = []
+        for i, (face, normal, uv, obj_id) in enumerate(
+            zip(
+                self.faces.tolist(),
+                self.normals.tolist(),
+                self.uvs.tolist(),
+                self.object_ids.tolist(),
+            )
+        ):
+            triangle = Triangle([points[j] for j in face])
+            triangle.textureCoords = tuple(uv)
+            triangle.normal = Vector(*normal)
+            triangle.id = i
+            objects[obj_id].triangles.append(triangle)
+            triangles.append(triangle)
+        for i, obj in enumerate(objects):
+            obj.id = i
+            used = np.unique(self.faces[self.object_start[i] : self.object_end[i]])
+            obj.points = [points[j] for j in used.tolist()]
+            obj.bounding_box = [
+                Vector(*self.object_min[i]),
+                Vector(*self.object_max[i]),
+            ]
+        self._objects = objects
+        self._triangles = triangles
+
+    def __repr__(self):
+        return (
+            f"[TriangleMesh: {len(self.object_names)} objects, {len(self.faces)} tris]"
+        )
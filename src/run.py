@@ -5,6 +5,7 @@ from twobounce2 import *
 from twobounce2 import ObjLoader
 import sys
 import TextureModule
+from Emitters import SOURCES, ImportanceSource
 
 """
  ___  ____                                   ____  _____
@@ -16,8 +17,12 @@ import TextureModule
                   labarrett@umass.edu
 """
 
-# default to 1 million rays if input not provided
-N = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+# default to 1 million rays if input not provided, "--checkpoint" saves progress to
+# CHECKPOINT and "--resume" finishes the run saved there
+ARGS = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+N = int(ARGS[0]) if ARGS else 1_000_000
+RESUME = "--resume" in sys.argv
+CHECKPOINTING = RESUME or "--checkpoint" in sys.argv
 
 
 def printResults(stats: list[dict]) -> None:
@@ -38,21 +43,78 @@ def printResults(stats: list[dict]) -> None:
 
     print(f"Hit critical geometry: {hitCrit}, {hitCrit / totalRays * 100: .3f}%")
     print(f"Hit any geometry: {hitObj / totalRays * 100: .1f}%")
+    if all("w_hit_critical" in stat for stat in stats):
+        # weighted estimates, unbiased for rays uniform over the sphere whatever the
+        # emitter
+        for key, label in [
+            ("hit_critical", "critical geometry"),
+            ("hit_obj", "any geometry"),
+        ]:
+            mean, err = weightedFraction(stats, key)
+            print(f"Weighted hit {label}: {mean * 100: .4f}% +/- {err * 100: .4f}%")
 
 
-def main(N=N) -> None:
+def main(
+    N=N,
+    engine=None,
+    mode="full",
+    emitter=None,
+    rel_err=None,
+    time_limit=None,
+    checkpoint=None,
+    resume=False,
+    progress_log=None,
+) -> None:
     """
     Main function for running sim
+    :param N: number of rays, the maximum number of rays if rel_err or time_limit is
+        given
+    :param engine: intersection engine, "bvh", "numba", "numpy" or "python" (default:
+        see TwobounceSession)
+    :param mode: "full" writes every hit to ./output, "texture" only the hit counts per
+        texture pixel (default: "full")
+    :param emitter: source from Emitters.SOURCES for reproducible rays (default: None,
+        unseeded random module)
+    :param rel_err: stop early once hit_critical is known to this relative error
+        (default: None)
+    :param time_limit: stop early after this many seconds (default: None)
+    :param checkpoint: file progress is saved to, so a run that was killed can be
+        resumed (default: None)
+    :param resume: finish the run saved in checkpoint instead of starting a new one
+        (default: False)
+    :param progress_log: file to append JSON lines of progress and throughput to
+        (default: None)
     :return: None
     """
 
     t1 = time.time()
     print()
     print("Starting twobounce")
-    ans = multicoreIterateMap(objs, N)
+    try:
+        ans = multicoreIterateMap(
+            objs,
+            N,
+            engine,
+            mode,
+            emitter=emitter,
+            rel_err=rel_err,
+            time_limit=time_limit,
+            checkpoint=checkpoint,
+            resume=resume,
+            progress_log=progress_log,
+        )
+    except KeyboardInterrupt:
+        if checkpoint:
+            print(
+                f"Interrupted, progress saved to {checkpoint}, "
+                "run with --resume to continue"
+            )
+            sys.exit(130)
+        raise
     printResults(ans)
     print("Finished")
     deltat = time.time() - t1
+    N = sum(stat["num_rays"] for stat in ans)  # rays actually traced
     print(f"Simulated {N} rays using {CPU_COUNT} cores in {deltat: .2f}s")
     print(f"Time per 1k rays: {deltat / (N / 1000) : .2g}s")
     print(f"Time per 1k rays per core: {deltat / ((N / 1000) / mp.cpu_count()) : .2g}s")
@@ -73,15 +135,47 @@ def oneVec() -> None:
 
 if __name__ == "__main__":
     FILENAME = "FourCubes"
+    # "numba" for the compiled engine, "bvh" for the Python one (private BVH lists in
+    # every worker), "numpy" to test every triangle, "python" for the original
+    # per-triangle loop, None for numba on several cores
+    ENGINE = None
+    # "full" writes every hit to ./output, "texture" sums hits per texture pixel in the
+    # workers (same images, output size independent of N)
+    MODE = "full"
+    # same seed gives the same results for any core count, None for a random seed
+    SEED = 0
+    # "sobol", "halton", "stratified" or "random" (uniform over the sphere), "thetaphi"
+    # for the original emitter,
+    # "importance" to aim half the rays at the critical objects (weighted results)
+    EMITTER = "sobol"
+    # e.g. 0.05 to stop once hit_critical is known to 5% (N is then the maximum)
+    REL_ERR = None
+    TIME_LIMIT = None  # seconds, stop early once reached
+    # progress of "python run.py --checkpoint", "--resume" continues it
+    CHECKPOINT = "./checkpoint.pkl"
+    PROGRESS_LOG = None  # e.g. "./progress.jsonl" to log rays/sec and ETA as JSON lines
     initalize()
     print("Loading geometry")
     loader = ObjLoader("./")
-    objs, tris = loader.load(FILENAME + ".obj")
+    objs = loader.loadMesh(FILENAME + ".obj")  # packed arrays, cheap to send to workers
     # objs, tris = loader.load("untitled.obj")
     print(f"Done")
-    print(f"{len(objs)} objects, {len(tris)} polygons\n")
+    print(f"{len(objs.object_names)} objects, {len(objs)} polygons\n")
     # oneVec()
-    main()
+    if EMITTER == "importance":
+        emitter = ImportanceSource(objs, seed=SEED)
+    else:
+        emitter = SOURCES[EMITTER](seed=SEED)
+    main(
+        engine=ENGINE,
+        mode=MODE,
+        emitter=emitter,
+        rel_err=REL_ERR,
+        time_limit=TIME_LIMIT,
+        checkpoint=CHECKPOINT if CHECKPOINTING else None,
+        resume=RESUME,
+        progress_log=PROGRESS_LOG,
+    )
 
     TextureModule.main(FILENAME)
     # timePerformance()
@@ -1,19 +1,58 @@
-import copy
 import functools
+import glob
+import io
+import itertools
 import math
 import multiprocessing as mp
+import os
+import pickle
+import queue
+import signal
 import time
 from functools import partial
 from pprint import pprint
 import random as r
 from math import sin, cos
 from GeometricObjects import *
+from Intersections import intersectRay, intersectRays, rayBox, rayBoxes
+from TriangleMesh import TriangleMesh
+from Emitters import CHUNK, PointSource
+from SharedMesh import SharedMesh
+from Progress import (
+    ProgressReporter,
+    progressCounters,
+    progressRows,
+    claimRow,
+    addProgress,
+)
+from HitRecords import hitHeader, writeHitRecords
+import twobounce2_NUMBA
 from tqdm import tqdm
 import numpy as np
 
 # import numpy as np
 
 CPU_COUNT = mp.cpu_count()
+# default intersection engine: "bvh", "numba" (compiled bvh, falls back to "bvh" without
+# numba), "numpy" (every triangle at once) or "python" (Triangle.intersect loop)
+ENGINE = "bvh"
+# "bvh" and "numba" test rays against Baldwin-Weber transforms instead of edges
+# (TriangleMesh.precompute)
+TRANSFORM = False
+# multicoreIterateMap sizes chunks of rays to take about this long on one worker
+CHUNK_SECONDS = 0.5
+# smallest chunk of rays handed to a worker, one emitter chunk (Emitters.CHUNK)
+MIN_CHUNK = CHUNK
+CHECKPOINT_SECONDS = 60  # TwobounceSession.run saves its checkpoint file this often
+# TwobounceSession.chunks checks that no pool worker died this often while it waits
+POLL_SECONDS = 1
+# hits of "full" runs, "binary" for ./output/hits_<n>.bin (see HitRecords), "text" for
+# ./output/output_<n>.txt
+OUTPUT = "binary"
+OUTPUT_FILES = {"binary": "./output/hits_{}.bin", "text": "./output/output_{}.txt"}
+TEXTURE_SIZE = 200  # pixels per side of the hit count images of "texture" runs
+# hit counts of the last "texture" run, see saveTextures
+TEXTURE_FILE = "./output/texture.npz"
 
 # pprint("")
 
@@ -32,8 +71,7 @@ def print(s=""):
 
 
 def initalize():
-    printf(
-        r"""
+    printf(r"""
  ___  ____                                   ____  _____
 |__ \|  _ \                                 |___ \|  __ \
    ) | |_) | ___  _   _ _ __   ___ ___       __) | |  | |
@@ -41,8 +79,7 @@ def initalize():
  / /_| |_) | (_) | |_| | | | | (_|  __/      ___) | |__| |
 |____|____/ \___/ \__,_|_| |_|\___\___|     |____/|_____/
 Luc Barrett, Nov. 2022
-        """
-    )
+        """)
     print(f"CPU Core Count: {CPU_COUNT}\n")
 
 
@@ -58,165 +95,566 @@ class ObjLoader:
         :param filename: Name of file in path, ex: test_file.obj
         :return: Tuple containing list of objects and full list of triangles
         """
-        verticies = []
-        objects = []
-        triangles = []
-        normals = []
-        texture_verticies = []
-        with open(self.path + filename, "r") as f:
-            curObject = None
-            for line in f.readlines():
-                if line[0] in ["o", "g"]:
-                    name = line.split(" ")[1].strip("\n")
-                    args = name.split("-")
-
-                    # print(f"Loading {name}")
-                    curObject = TriObject(name, [], [], "crit" in args)
-                    objects.append(curObject)
-                if line[0] == "#":
-                    continue
-                if line[0] == "v" and line[1] == " ":
-                    split = line.split(" ")
-                    verticies.append(
-                        Vector(float(split[1]), float(split[2]), float(split[3]))
-                    )
-                    curObject.points.append(
-                        Vector(float(split[1]), float(split[2]), float(split[3]))
-                    )
-                if line[0] == "v" and line[1] == "n":
-                    split = line.split(" ")
-                    normals.append(
-                        Vector(float(split[1]), float(split[2]), float(split[3]))
-                    )
-                if line[0] == "v" and line[1] == "t":
-                    split = line.split(" ")
-                    texture_verticies.append([float(split[1]), float(split[2])])
-                if line[0] == "f":
-                    split = line.split(" ")
-                    v1 = split[1].split("/")
-                    v2 = split[2].split("/")
-                    v3 = split[3].split("/")
-                    triangle = Triangle(
-                        (
-                            verticies[int(v1[0]) - 1],
-                            verticies[int(v2[0]) - 1],
-                            verticies[int(v3[0]) - 1],
-                        )
-                    )
-                    triangle.textureCoords = (
-                        texture_verticies[int(v1[1]) - 1],
-                        texture_verticies[int(v2[1]) - 1],
-                        texture_verticies[int(v3[1]) - 1],
-                    )
-                    triangle.normal = normals[int(v1[2]) - 1]
-                    curObject.triangles.append(triangle)
-                    triangles.append(triangle)
-        # print(f"{len(triangles)} polygons loaded")
-        return objects, triangles
+        mesh = self.loadMesh(filename)
+        return mesh.objects, mesh.triangles
+
+    def loadMesh(self, filename) -> TriangleMesh:
+        """
+        :param filename: Name of file in path, ex: test_file.obj
+        :return: packed TriangleMesh, TriObject/Triangle views are built from it on
+            demand
+        """
+        return TriangleMesh.fromObj(self.path + filename)
+
+
+TRACE_DTYPE = np.dtype(
+    [
+        ("ray", "<i8"),  # ray number, -1 if not set
+        ("start", "<f8", (3,)),
+        ("direction", "<f8", (3,)),
+        ("t", "<f8"),  # inf on a miss
+        # barycentric coordinates of the hit (weights of the second and third vertex)
+        ("u", "<f8"),
+        ("v", "<f8"),
+        ("face", "<i8"),  # face index of the TriangleMesh, -1 on a miss
+    ]
+)
+
+
+def traceRecords(shape) -> np.ndarray:
+    """
+    :param shape: shape of the array, (rays, 2) for both bounces of a block of rays
+    :return: TRACE_DTYPE array of misses, for checkIntersections and twobounce to fill
+        in place
+    """
+    records = np.zeros(shape, dtype=TRACE_DTYPE)
+    records["ray"] = -1
+    records["t"] = np.inf
+    records["face"] = -1
+    return records
 
 
 class Hit:
-    def __init__(
-        self,
-        start: Vector,
-        vec: Vector,
-        t: float,
-        tri: Triangle,
-        obj: TriObject,
-        didHit: bool,
-    ):
-        self.start = start
-        self.vec = vec
-        self.t = t
-        self.tri = tri
-        self.obj = obj
-        self.hit = didHit
-        self.n = None
-        # triangle coordinates
-        self.u = None
-        self.v = None
-        self.hitDict = {
+    """
+    View of one record of a TRACE_DTYPE array, which checkIntersections fills in place
+    Vectors, the Triangle and TriObject views and the debug dictionary are only built
+    when they are asked for
+    """
+
+    __slots__ = ("records", "i", "mesh")
+
+    def __init__(self, records=None, i=0, mesh=None):
+        """
+        :param records: 1d TRACE_DTYPE array (default: None, a new single miss record)
+        :param i: index of the record
+        :param mesh: TriangleMesh the face index refers to
+        """
+        self.records = traceRecords(1) if records is None else records
+        self.i = i
+        self.mesh = mesh
+
+    @property
+    def hit(self) -> bool:
+        return bool(self.records["face"][self.i] >= 0)
+
+    @property
+    def face(self) -> int:
+        return int(self.records["face"][self.i])
+
+    @property
+    def n(self):
+        ray = int(self.records["ray"][self.i])
+        return ray if ray >= 0 else None
+
+    @n.setter
+    def n(self, ray):
+        self.records["ray"][self.i] = -1 if ray is None else ray
+
+    @property
+    def traced(self) -> bool:
+        """
+        :return: False for a record no ray was traced into (the second bounce of a ray
+            that missed everything), a traced ray always has a direction
+        """
+        return self.hit or bool(self.records["direction"][self.i].any())
+
+    @property
+    def start(self) -> Vector:
+        return Vector(*self.records["start"][self.i].tolist()) if self.traced else None
+
+    @property
+    def vec(self) -> Vector:
+        return (
+            Vector(*self.records["direction"][self.i].tolist()) if self.traced else None
+        )
+
+    @property
+    def t(self):
+        return float(self.records["t"][self.i]) if self.hit else None
+
+    @property
+    def u(self):
+        return float(self.records["u"][self.i]) if self.hit else None
+
+    @property
+    def v(self):
+        return float(self.records["v"][self.i]) if self.hit else None
+
+    @property
+    def tri(self):
+        return self.mesh.triangles[self.face] if self.hit else None
+
+    @property
+    def obj(self):
+        return self.mesh.objects[self.mesh.object_ids[self.face]] if self.hit else None
+
+    @property
+    def hitDict(self) -> dict:
+        """
+        :return: debugging summary of the hit (see run.oneVec)
+        """
+        hitDict = {
             "Start point": self.start,
             "Direction Vector": self.vec,
             "t": self.t,
             "Hit object": self.obj,
-            # "Hit triangle"    : self.tri
         }
-        if self.obj:
-            self.hitDict["Collison"] = self.coord()
+        if self.hit:
+            hitDict["Collison"] = self.coord()
+        return hitDict
 
     def coord(self):
         return self.vec.calcCoord(self.start, self.t)
 
     def __bool__(self):
-        if self.hit is None:
-            return False
         return self.hit
 
     def __repr__(self):
-        if self.obj:
-            return f"<HitInfo - hit {self.obj.name}>"
+        if self.hit:
+            name = self.mesh.object_names[self.mesh.object_ids[self.face]]
+            return f"<HitInfo - hit {name}>"
         else:
             return f"<HitInfo - hit None>"
 
 
-def checkIntersections(objects: list[TriObject], st: Vector, ray: Vector) -> Hit:
+@functools.lru_cache(maxsize=8)
+def packObjects(objects: tuple) -> TriangleMesh:
+    """
+    Pack a tuple of objects for the numpy engine, cached so it is only done once per
+    scene
+    :param objects: tuple of Objects
+    :return: TriangleMesh using objects as its views
+    """
+    return TriangleMesh.fromObjects(list(objects))
+
+
+def asMesh(objects) -> TriangleMesh:
+    """
+    :param objects: TriangleMesh or list of Objects
+    :return: TriangleMesh for objects
+    """
+    if isinstance(objects, TriangleMesh):
+        return objects
+    return packObjects(tuple(objects))
+
+
+def prepareMesh(objects, engine=None, mode="full") -> TriangleMesh:
+    """
+    Pack objects and build every acceleration structure the run will use, so it is built
+    once and shared with the workers instead of once per worker
+    :param objects: TriangleMesh or list of Objects
+    :param engine: intersection engine (default: ENGINE)
+    :param mode: "full" or "stats" (hitsCritical uses the critical / other BVHs)
+    :return: TriangleMesh
+    """
+    mesh = asMesh(objects).precompute(TRANSFORM)
+    if getEngine(engine) in ["bvh", "numba"]:
+        mesh.bvh
+    if mode == "stats" and getEngine(engine) != "numba":
+        mesh.critical_bvh
+        mesh.other_bvh
+    return mesh
+
+
+def asObjects(objects) -> list[TriObject]:
+    """
+    :param objects: TriangleMesh or list of Objects
+    :return: list of Objects
+    """
+    if isinstance(objects, TriangleMesh):
+        return objects.objects
+    return objects
+
+
+def getEngine(engine: str = None) -> str:
+    """
+    :param engine: requested engine (default: ENGINE)
+    :return: engine to use, "numba" is replaced by "bvh" if numba is not installed
+    """
+    engine = engine or ENGINE
+    if engine == "numba" and not twobounce2_NUMBA.NUMBA_AVAILABLE:
+        return "bvh"
+    return engine
+
+
+def checkIntersections(
+    objects: list[TriObject] | TriangleMesh,
+    st: Vector,
+    ray: Vector,
+    engine: str = None,
+    ignore: int = -1,
+    offset: float = 0.0,
+    out: Hit = None,
+) -> Hit:
     """
     Finds first intersection of ray starting at st with any object
 
-    Future optimization options:
-        - Check for bounding box intersection first
-        - Organize objects into tree (?)
-    :param objects: list of Objects
+    Rays that miss the scene bounding box return straight away. The "numpy" and "python"
+    engines then test object bounding boxes nearest first and skip objects whose box is
+    further away than the closest hit, the "bvh" engine does the same with its node
+    boxes
+    :param objects: list of Objects or TriangleMesh
     :param st: starting Vector
     :param ray: direction Vector
-    :return: Hit class containing hit info
+    :param engine: "bvh", "numba", "numpy" or "python" (default: ENGINE)
+    :param ignore: id of a triangle to skip, normally the one the ray starts on
+        (default: -1, none)
+    :param offset: move st this far off the ignored triangle along its normal, towards
+        the ray (default: 0)
+    :param out: Hit whose record is filled in (default: None, a new one)
+    :return: out, the Hit containing hit info
     """
+    engine = getEngine(engine)
+    mesh = asMesh(objects)
+    if offset and ignore >= 0:
+        n = Vector(*mesh.unit_normals[ignore])
+        side = 1 if ray.dot(n) >= 0 else -1
+        st = st + n * (side * offset)
     min_t = math.inf
-    lastVec = None
-    u = None
-    v = None
-    hitInfo = [st, ray, None, None, None, None]
-    for obj in objects:
-        for tri in obj.triangles:
-            hit, vec = tri.intersect(st, ray)
-            if hit and vec.x < min_t:
-                min_t = vec.x
-                hitInfo[2] = min_t
-                hitInfo[3] = tri
-                hitInfo[4] = obj
-                hitInfo[5] = hit
-                u = vec.u
-                v = vec.v
-    h = Hit(*hitInfo)
-    h.u = u
-    h.v = v
-    return h
-
-
-def twobounce(objects: list[TriObject], st: Vector, ray: Vector) -> tuple[Hit, Hit]:
-    """
-    :param objects: List of objects
+    face = -1
+    u = 0.0
+    v = 0.0
+
+    if engine in ["bvh", "numba"]:  # the root node is the scene box
+        if engine == "bvh":
+            t, tu, tv, i = mesh.bvh.intersect(st.arr, ray.arr, ignore=ignore)
+        else:
+            t, tu, tv, i = twobounce2_NUMBA.intersect(mesh, st.arr, ray.arr, ignore)
+        if i >= 0:
+            min_t, u, v, face = t, tu, tv, i
+    elif rayBox(mesh.bounds[0], mesh.bounds[1], st.arr, ray.arr) < math.inf:
+        boxes = rayBoxes(mesh.object_min, mesh.object_max, st.arr, ray.arr)
+        for o in np.argsort(boxes, kind="stable").tolist():
+            # every remaining box is further than the closest hit (or missed)
+            if boxes[o] >= min_t:
+                break
+            if engine == "numpy":
+                start, end = mesh.object_start[o], mesh.object_end[o]
+                t, tu, tv, i = intersectRay(
+                    mesh.v0[start:end],
+                    mesh.edge1[start:end],
+                    mesh.edge2[start:end],
+                    st.arr,
+                    ray.arr,
+                    ignore=ignore - start,
+                )
+                if i >= 0 and t < min_t:
+                    min_t, u, v, face = t, tu, tv, start + i
+                continue
+            for tri in mesh.objects[o].triangles:
+                if tri.id == ignore:
+                    continue
+                hit, vec = tri.intersect(st, ray)
+                if hit and vec.x < min_t:
+                    min_t, u, v, face = vec.x, vec.u, vec.v, tri.id
+    if out is None:
+        out = Hit(mesh=mesh)
+    out.mesh = mesh
+    records, i = out.records, out.i
+    # one write for the whole record
+    records[i] = (records["ray"][i], st.arr, ray.arr, min_t, u, v, face)
+    return out
+
+
+def twobounce(
+    objects: list[TriObject] | TriangleMesh,
+    st: Vector,
+    ray: Vector,
+    engine: str = None,
+    offset: float = 0.0,
+    out=None,
+) -> tuple[Hit, Hit]:
+    """
+    :param objects: List of objects or TriangleMesh
     :param st: Start of ray
     :param ray: Direction of ray
+    :param engine: intersection engine passed to checkIntersections (default: ENGINE)
+    :param offset: distance to move the second bounce start off the first hit surface
+        (default: 0)
+    :param out: (2,) TRACE_DTYPE array the two bounces are written to, e.g. a row of
+        traceRecords((n, 2)) (default: None, a new one), it should be all misses, a
+        missed first bounce leaves the second as it is
     :return: (res1, res2) where res1 is Hit information of first collision, res2 is Hit information of second collision
     """
-    objects = copy.copy(objects)
+    mesh = asMesh(objects)
+    if out is None:
+        out = traceRecords(2)
     # One bounce
-    result = checkIntersections(objects, st, ray)
+    result = checkIntersections(mesh, st, ray, engine, out=Hit(out, 0, mesh))
     if not result.hit:
-        return (result, Hit(None, None, None, None, None, False))
+        return result, Hit(out, 1, mesh)
     coords = result.coord()  # coords becomes new start
 
     # two bounce
-    n = result.tri.normal  # normal vector to triangle
-    # new_r = ray - n * 2 * (ray.dot(n))  # new direction vector from reflection
-    new_r = ray - n * ((ray * 2).dot(n) / (abs(n) * abs(n)))
-    # objects.remove(result.obj)  # remove originating structure from objects to avoid floating point error causing hit
-    result2 = checkIntersections(objects, coords, new_r)
+    face = result.face
+    n = Vector(*mesh.unit_normals[face])  # unit normal vector to triangle
+    new_r = ray - n * (2 * ray.dot(n))  # new direction vector from reflection
+    # skip the triangle the ray reflects off so floating point error can not cause a hit
+    # on it
+    result2 = checkIntersections(
+        mesh, coords, new_r, engine, face, offset, Hit(out, 1, mesh)
+    )
     return result, result2
 
 
+def _criticalFirst(mesh: TriangleMesh, st, ray, ignore=-1) -> bool:
+    """
+    :return: True if the closest hit of the ray is on critical geometry
+    """
+    t = mesh.critical_bvh.intersect(st, ray, ignore=ignore)[0]
+    return t < math.inf and not mesh.other_bvh.occluded(st, ray, t, ignore)
+
+
+def hitsCritical(objects: list[TriObject] | TriangleMesh, st, ray) -> tuple[bool, bool]:
+    """
+    Any hit version of twobounce for stats only runs, no Hit objects are built
+    Critical geometry is checked first, and a bounce only needs a full closest hit
+    search when its closest critical hit turns out to be blocked by other geometry (or
+    there is none)
+    :param objects: List of objects or TriangleMesh
+    :param st: start of ray, sequence of 3 floats
+    :param ray: direction of ray, sequence of 3 floats
+    :return: (hit_obj, hit_critical) for the two bounce path of the ray
+    """
+    mesh = asMesh(objects)
+    if _criticalFirst(mesh, st, ray):
+        return True, True
+    t, u, v, i = mesh.bvh.intersect(st, ray)
+    if i < 0:
+        return False, False
+    n = mesh.unit_normals[i].tolist()
+    scale = 2 * sum(d * m for d, m in zip(ray, n))
+    coords = [s + d * t for s, d in zip(st, ray)]
+    new_r = [d - m * scale for d, m in zip(ray, n)]
+    return True, _criticalFirst(mesh, coords, new_r, i)
+
+
+def traceRays(
+    objects: list[TriObject] | TriangleMesh, starts, dirs, engine: str = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Batched twobounce, follows every ray for two bounces without building Vector or Hit
+    objects (the "python" engine fills a traceRecords array with twobounce)
+    :param objects: List of objects or TriangleMesh
+    :param starts: (n, 3) ray starts (or one (3,) start shared by every ray)
+    :param dirs: (n, 3) ray directions
+    :param engine: intersection engine (default: ENGINE)
+    :return: (faces, us, vs), (n, 2) arrays with the face, u and v of each bounce, face
+        is -1 for no hit
+    """
+    engine = getEngine(engine)
+    mesh = asMesh(objects)
+    dirs = np.atleast_2d(np.asarray(dirs, dtype=np.float64))
+    starts = np.broadcast_to(np.asarray(starts, dtype=np.float64), dirs.shape)
+    if engine == "numba":
+        return twobounce2_NUMBA.trace(mesh, starts, dirs)
+
+    n = len(dirs)
+    if engine == "python":
+        records = traceRecords((n, 2))
+        for st, d, row in zip(starts.tolist(), dirs.tolist(), records):
+            twobounce(mesh, Vector(*st), Vector(*d), engine, out=row)
+        return records["face"].copy(), records["u"].copy(), records["v"].copy()
+
+    faces = np.full((n, 2), -1, dtype=np.int64)
+    us = np.zeros((n, 2))
+    vs = np.zeros((n, 2))
+
+    if engine == "bvh":
+        intersect = mesh.bvh.intersectRays
+    else:
+        intersect = partial(intersectRays, mesh.v0, mesh.edge1, mesh.edge2)
+    t, u, v, i = intersect(starts, dirs)
+    hit = i >= 0
+    faces[:, 0], us[hit, 0], vs[hit, 0] = i, u[hit], v[hit]
+
+    # reflect the rays that hit about their face normal and bounce again
+    nrm = mesh.unit_normals[i[hit]]
+    d = dirs[hit]
+    scale = 2 * np.einsum("ij,ij->i", d, nrm)
+    coords = starts[hit] + d * t[hit, None]
+    t, u, v, i2 = intersect(coords, d - nrm * scale[:, None], ignore=i[hit])
+    faces[hit, 1] = i2
+    hit2 = np.nonzero(hit)[0][i2 >= 0]
+    us[hit2, 1] = u[i2 >= 0]
+    vs[hit2, 1] = v[i2 >= 0]
+    return faces, us, vs
+
+
+def hitFlags(mesh: TriangleMesh, faces) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param mesh: TriangleMesh
+    :param faces: (n, 2) face hit on each bounce, -1 for no hit
+    :return: (hit, crit), (n,) bool arrays, True where the ray hit anything / critical
+        geometry
+    """
+    hit = faces >= 0
+    crit = hit & mesh.critical[faces]
+    return hit[:, 0], crit.any(axis=1)
+
+
+def countHits(mesh: TriangleMesh, faces) -> tuple[int, int]:
+    """
+    :param mesh: TriangleMesh
+    :param faces: (n, 2) face hit on each bounce, -1 for no hit
+    :return: (number of rays that hit anything, number of rays that hit critical
+        geometry)
+    """
+    hit, crit = hitFlags(mesh, faces)
+    return int(hit.sum()), int(crit.sum())
+
+
+def addStats(stats: dict, hit, crit, weights) -> None:
+    """
+    Add a block of rays to a stats dictionary
+    Besides the plain counts, sums of w * x and (w * x)^2 are kept for the weighted
+    estimate of each fraction
+    (w is 1 for every ray of an unweighted emitter), see printResults
+    :param stats: stats dictionary to update
+    :param hit: (n,) bool, ray hit anything
+    :param crit: (n,) bool, ray hit critical geometry
+    :param weights: (n,) ray weights
+    """
+    stats["num_rays"] += len(hit)
+    stats["hit_obj"] += int(np.count_nonzero(hit))
+    stats["hit_critical"] += int(np.count_nonzero(crit))
+    for key, flags in [("hit_obj", hit), ("hit_critical", crit)]:
+        wx = np.where(flags, weights, 0.0)
+        stats[f"w_{key}"] = stats.get(f"w_{key}", 0.0) + float(wx.sum())
+        stats[f"w2_{key}"] = stats.get(f"w2_{key}", 0.0) + float(np.dot(wx, wx))
+
+
+def mergeStats(total: dict, stats: dict) -> None:
+    """
+    Add the counts and sums of one stats dictionary to another
+    :param total: stats dictionary to update
+    :param stats: stats dictionary to add
+    """
+    for key, value in stats.items():
+        total[key] = total.get(key, 0) + value
+
+
+def weightedFraction(stats: list[dict], key: str) -> tuple[float, float]:
+    """
+    Combine the weighted sums kept by addStats
+    For unit weights the standard error is the binomial one, sqrt(p (1 - p) / (n - 1))
+    :param stats: list of stats dictionaries
+    :param key: "hit_critical" or "hit_obj"
+    :return: (estimated fraction, standard error of the estimate)
+    """
+    n = sum(stat["num_rays"] for stat in stats)
+    if n == 0:
+        return 0.0, math.inf
+    mean = sum(stat[f"w_{key}"] for stat in stats) / n
+    second = sum(stat[f"w2_{key}"] for stat in stats) / n
+    err = math.sqrt(max(0.0, second - mean**2) / (n - 1)) if n > 1 else math.inf
+    return mean, err
+
+
+def relativeError(stats: dict, z=1.96, min_hits=10) -> float:
+    """
+    Half width of the confidence interval of the weighted hit_critical fraction,
+    relative to the fraction
+    The error is the i.i.d. (binomial) one, which overstates it for Sobol and Halton
+    rays (their spread is often an order of magnitude lower), so quasi random runs stop
+    no earlier than pseudo random ones
+    :param stats: stats dictionary with weighted sums (see addStats)
+    :param z: normal quantile of the interval (default: 1.96, 95%)
+    :param min_hits: the error is inf until this many rays hit critical geometry, the
+        normal approximation is meaningless before that
+    :return: relative error
+    """
+    if stats.get("hit_critical", 0) < min_hits:
+        return math.inf
+    mean, err = weightedFraction([stats], "hit_critical")
+    return z * err / mean if mean > 0 else math.inf
+
+
+def traceChunk(
+    objs,
+    b0,
+    b1,
+    engine=None,
+    mode="full",
+    emitter=None,
+    outFile=None,
+    progress=None,
+    output="text",
+    texture_size=TEXTURE_SIZE,
+) -> dict:
+    """
+    Trace rays b0 to b1 of an emitter, one emitter block at a time
+    :param objs: list of objects or TriangleMesh
+    :param engine: intersection engine (default: ENGINE)
+    :param mode: "full" traces closest hits (and writes them to outFile), "texture"
+        traces closest hits and counts them per texture pixel in stats["texture"] as
+        (index, counts, texture_size) of the pixels hit (see binTextureHits), "stats"
+        only counts rays with hitsCritical (the numba engine always traces)
+    :param emitter: source from Emitters
+    :param outFile: open file for the hits, None to skip writing
+    :param progress: called with (rays, hits, crits) after every block (default: None)
+    :param output: format of outFile, "text" (see writeHits) or "binary" (see
+        HitRecords.writeHitRecords)
+    :param texture_size: pixels per side of the "texture" counts (default: TEXTURE_SIZE)
+    :return: stats dictionary of the chunk
+    """
+    stats = {
+        "num_rays": 0,
+        "hit_obj": 0,
+        "hit_critical": 0,
+    }
+    texture = []  # (index, counts) of every block
+    for c0, c1 in emitter.blocks(b0, b1):
+        starts, dirs = emitter.rays(c0, c1)
+        if mode == "stats" and getEngine(engine) != "numba":
+            hit, crit = (
+                np.array(
+                    [
+                        hitsCritical(objs, st, d)
+                        for st, d in zip(starts.tolist(), dirs.tolist())
+                    ],
+                    dtype=bool,
+                )
+                .reshape(-1, 2)
+                .T
+            )
+        else:
+            faces, us, vs = traceRays(objs, starts, dirs, engine)
+            hit, crit = hitFlags(asMesh(objs), faces)
+            if outFile and output == "binary":
+                writeHitRecords(outFile, asMesh(objs), faces, us, vs, c0)
+            elif outFile:
+                writeHits(outFile, asMesh(objs), faces, us, vs)
+            if mode == "texture":
+                texture.append(textureCounts(asMesh(objs), faces, us, vs, texture_size))
+        addStats(stats, hit, crit, emitter.weights(dirs))
+        if progress:
+            progress(c1 - c0, int(np.count_nonzero(hit)), int(np.count_nonzero(crit)))
+    if mode == "texture":
+        stats["texture"] = (*mergeTextureCounts(texture), texture_size)
+    return stats
+
+
 def linspace(start, stop, n):
     """
     Copy of numpys linspace, with integer divide
@@ -236,7 +674,8 @@ def linspace(start, stop, n):
 def calcTextureCoordinate(u, v, w, textureCoords):
     """
     Take in u,v,w for collision and calculate the coordinate in the texture file for the hit
-
+    Triangle.textureCoordinate and TriangleMesh.textureCoordinates do the same with
+    precomputed maps
     """
     coord = [w, u, v]
     textureCoords = np.asarray(textureCoords)
@@ -251,9 +690,7 @@ def writeToFile(file, res: list[Hit, Hit]):
         else:
             # file.write(f"{hit.n}\t{i}\t{hit.obj.name :>20}\t{hit.start}\t{hit.coord()}\n")
             # TODO update hit and tri class
-            point_coords = calcTextureCoordinate(
-                hit.u, hit.v, 1 - hit.u - hit.v, hit.tri.textureCoords
-            )
+            point_coords = hit.tri.textureCoordinate(hit.u, hit.v)
             file.write(
                 f"{hit.obj.name}\t{i}\t"
                 # + f"{hit.u},{hit.v}\t{hit.tri.textureCoords[0][0]},{hit.tri.textureCoords[0][1]}\t"
@@ -263,19 +700,200 @@ def writeToFile(file, res: list[Hit, Hit]):
             )
 
 
+def writeHits(file, mesh: TriangleMesh, faces, us, vs):
+    """
+    Write the hits of a block of rays in the same format as writeToFile
+    :param file: open output file
+    :param mesh: TriangleMesh
+    :param faces: (n, 2) face hit on each bounce, -1 for no hit
+    :param us: (n, 2) u of each hit
+    :param vs: (n, 2) v of each hit
+    """
+    # row major, so bounces of a ray stay together
+    rows, bounce = np.nonzero(faces >= 0)
+    f = faces[rows, bounce]
+    coords = mesh.textureCoordinates(f, us[rows, bounce], vs[rows, bounce])
+    names = mesh.object_names
+    file.write(
+        "".join(
+            f"{names[o]}\t{i}\t{x},{y}\n"
+            for o, i, (x, y) in zip(
+                mesh.object_ids[f].tolist(), bounce.tolist(), coords.tolist()
+            )
+        )
+    )
+
+
+def texturePixels(tex_u, tex_v, size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pixel of each texture coordinate in a size x size image, rows counted from the top
+    (v = 1) as in TextureModule's images, coordinates on the far edges go to the last
+    row or column
+    :param tex_u: (n,) texture u
+    :param tex_v: (n,) texture v
+    :return: (rows, columns), (n,) int arrays
+    """
+    x = np.clip((size * np.asarray(tex_u)).astype(np.int64), 0, size - 1)
+    y = np.clip((size - size * np.asarray(tex_v)).astype(np.int64), 0, size - 1)
+    return y, x
+
+
+def textureCounts(
+    mesh: TriangleMesh, faces, us, vs, size=TEXTURE_SIZE
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Bin the hits of a block of rays by object, bounce and texture pixel
+    :param mesh: TriangleMesh
+    :param faces: (n, 2) face hit on each bounce, -1 for no hit
+    :param us: (n, 2) u of each hit
+    :param vs: (n, 2) v of each hit
+    :param size: pixels per side
+    :return: (index, counts) of the pixels hit, see binTextureHits
+    """
+    rows, bounce = np.nonzero(faces >= 0)
+    f = faces[rows, bounce]
+    coords = mesh.textureCoordinates(f, us[rows, bounce], vs[rows, bounce])
+    return binTextureHits(mesh.object_ids[f], bounce, coords[:, 0], coords[:, 1], size)
+
+
+def binTextureHits(
+    objects, bounce, tex_u, tex_v, size=TEXTURE_SIZE
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Count hits per object, bounce and texture pixel, only the pixels that were hit are
+    returned so the result grows with the hits and not with the number of objects
+    :param objects: (n,) object index of each hit
+    :param bounce: (n,) 0 for a first hit, 1 after the reflection
+    :param tex_u: (n,) texture u of each hit
+    :param tex_v: (n,) texture v of each hit
+    :param size: pixels per side
+    :return: (index, counts), sorted flat indices into an (objects, 2, size, size) array
+        [object, bounce, row, column] and the hits on each, see addTextureCounts
+    """
+    y, x = texturePixels(tex_u, tex_v, size)
+    objects = np.asarray(objects, dtype=np.int64)
+    index = ((objects * 2 + np.asarray(bounce, dtype=np.int64)) * size + y) * size + x
+    return np.unique(index, return_counts=True)
+
+
+def addTextureCounts(total: dict, index, counts, size=TEXTURE_SIZE, keys=None) -> dict:
+    """
+    Add binned hits to per object counts, arrays are only allocated for the objects that
+    were hit
+    :param total: key -> (2, size, size) int64 hit counts, indexed [bounce, row,
+        column], updated in place
+    :param index: sorted flat indices from binTextureHits
+    :param counts: hits on each index
+    :param size: pixels per side
+    :param keys: key of each object index (default: None, the object index)
+    :return: total
+    """
+    objects, pixels = np.divmod(np.asarray(index), 2 * size * size)
+    bounds = np.flatnonzero(np.diff(objects)) + 1
+    for start, end in zip([0, *bounds.tolist()], [*bounds.tolist(), len(objects)]):
+        if start == end:
+            continue
+        key = int(objects[start])
+        key = key if keys is None else keys[key]
+        if key not in total:
+            total[key] = np.zeros((2, size, size), dtype=np.int64)
+        total[key].reshape(-1)[pixels[start:end]] += counts[start:end]
+    return total
+
+
+def mergeTextureCounts(parts) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param parts: list of (index, counts, ...) from binTextureHits or
+        sparseTextureCounts
+    :return: (index, counts) of all parts together
+    """
+    index = np.concatenate([np.zeros(0, dtype=np.int64)] + [part[0] for part in parts])
+    index, inverse = np.unique(index, return_inverse=True)
+    counts = np.zeros(len(index), dtype=np.int64)
+    np.add.at(
+        counts,
+        inverse,
+        np.concatenate([np.zeros(0, dtype=np.int64)] + [part[1] for part in parts]),
+    )
+    return index, counts
+
+
+def sparseTextureCounts(total: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param total: object index -> (2, size, size) hit counts, see addTextureCounts
+    :return: (index, counts) of the pixels hit, as binTextureHits gives them
+    """
+    index = [np.zeros(0, dtype=np.int64)]
+    counts = [np.zeros(0, dtype=np.int64)]
+    for key in sorted(total):
+        flat = total[key].reshape(-1)
+        pixels = np.flatnonzero(flat)
+        index.append(key * flat.size + pixels)
+        counts.append(flat[pixels])
+    return np.concatenate(index), np.concatenate(counts)
+
+
+def saveTextures(
+    filename: str, counts: dict, object_names: list[str], size=TEXTURE_SIZE
+) -> None:
+    """
+    :param counts: object index -> (2, size, size) hit counts of the objects hit, see
+        addTextureCounts
+    :param object_names: names of the objects, the file holds (objects, 2, size, size)
+        counts in this order
+    :param size: pixels per side
+    """
+    array = np.zeros((len(object_names), 2, size, size), dtype=np.int64)
+    for key, c in counts.items():
+        array[key] = c
+    np.savez_compressed(
+        filename, counts=array, objects=np.array(object_names, dtype=str)
+    )
+
+
+def loadTextures(filename: str) -> tuple[np.ndarray, list[str]]:
+    """
+    :return: (hit counts, object names) saved by saveTextures
+    """
+    with np.load(filename) as data:
+        return data["counts"], data["objects"].tolist()
+
+
 def iterateStartVecs(
-    n0, n, N, objs, results=None, shouldPrint=False, pid=0, lock=None
+    n0,
+    n,
+    N,
+    objs,
+    results=None,
+    shouldPrint=False,
+    pid=0,
+    lock=None,
+    engine=None,
+    mode="full",
+    emitter=None,
 ) -> dict:
     """
     Iterate over source vectors from n0 to n
     :param n0: starting n
     :param n: ending n
-    :param objs: list of objects
+    :param objs: list of objects or TriangleMesh (much cheaper to send to pool workers)
     :param results: deprecated? (default: none)
     :param shouldPrint: should print precentage (default: false)
     :param pid: process id (default: 0)
+    :param engine: intersection engine, "bvh", "numba", "numpy" or "python" (default:
+        ENGINE) "numba" runs the whole loop in twobounce2_NUMBA.iterateStartVecs
+    :param mode: "full" to trace closest hits and write them to ./output, "stats" to
+        only count rays with hitsCritical and write nothing (default: "full")
+    :param emitter: source from Emitters, rays are then generated and traced in blocks
+        and ray i is the same whichever process traces it. Adds weighted sums to the
+        stats, see addStats (default: None, one random ray at a time from the random
+        module)
     :return: void?
     """
+    if getEngine(engine) == "numba":
+        return twobounce2_NUMBA.iterateStartVecs(
+            n0, n, N, objs, results, shouldPrint, pid, lock, engine, mode, emitter
+        )
     LENGTH = 500  # length of "pencil"
     if results is None:
         results = []
@@ -286,7 +904,7 @@ def iterateStartVecs(
     }
 
     prec = 0  # percent tracker
-    outFile = open(f"./output/output_{pid}.txt", "w")
+    outFile = open(f"./output/output_{pid}.txt", "w") if mode == "full" else None
 
     with lock:  # show progress bars (sem lock to prevent overwriting each other)
         bar = tqdm(
@@ -300,65 +918,715 @@ def iterateStartVecs(
 
     div = (n - n0) // 7500  # used for progress bar
 
-    for t in range(n0, n):
-        if t % 7500 == 0:  # update progress bar in some interval
-            with lock:
-                bar.update(7500)
+    for b0, b1 in emitter.blocks(n0, n) if emitter else []:
+        mergeStats(stats, traceChunk(objs, b0, b1, engine, mode, emitter, outFile))
+        with lock:
+            bar.update(b1 - b0)
+
+    mesh = asMesh(objs)
+    for b0 in range(n0, n, 7500) if emitter is None else []:
+        b1 = min(b0 + 7500, n)
+        with lock:  # update progress bar in some interval
+            bar.update(b1 - b0)
+        # both bounces of every ray of the block, filled in place
+        records = traceRecords((b1 - b0, 2))
+        records["ray"] = np.arange(b0, b1)[:, None]
 
-        ###############################################################
-        # DEFINE VECTOR ITERATION
-        # start = Vector(0, 250 - t * LENGTH / N, 50) # moving point
-        start = Vector(0, 0, 0)  # static point
-        theta = r.random() * math.pi  # random theta
-        phi = r.random() * 2 * math.pi  # random phi
+        for row in records:
+            ###############################################################
+            # DEFINE VECTOR ITERATION
+            # start = Vector(0, 250 - t * LENGTH / N, 50) # moving point
+            start = Vector(0, 0, 0)  # static point
+            theta = r.random() * math.pi  # random theta
+            phi = r.random() * 2 * math.pi  # random phi
 
-        # dir = Vector(1, 0, 0)  # use spherical coords to calculate direction vector
-        dir = Vector(cos(phi) * sin(theta), sin(theta) * sin(phi), cos(theta))
+            # dir = Vector(1, 0, 0)  # use spherical coords to calculate direction
+            # vector
+            dir = Vector(cos(phi) * sin(theta), sin(theta) * sin(phi), cos(theta))
+
+            if mode == "stats":
+                thisHit, thisCrit = hitsCritical(mesh, start.arr, dir.arr)
+                stats["hit_critical"] += thisCrit
+                stats["hit_obj"] += thisHit
+                continue
+
+            # call two bounces, the responses go to row
+            twobounce(mesh, start, dir, engine, out=row)
+        stats["num_rays"] += b1 - b0
+        if mode == "stats":
+            continue
 
-        res = twobounce(objs, start, dir)  # call two bounces and get responses
-        res[0].n = t
-        res[1].n = t
         ##########################################################
         # Get stats
         # Track rays that hit critical geometry at any point in their path
         # or that hit objects at any point in their path
-        thisHits = 0
-        thisCrits = 0
-        for hit in res:
-            if hit.obj and hit.obj.critial:
-                thisCrits += 1
-            if hit.hit:
-                thisHits += 1
-        stats["hit_critical"] += 1 if thisCrits else 0
-        stats["hit_obj"] += 1 if thisHits else 0
-        stats["num_rays"] += 1
-        ##############################################
-        # results += res
-        # Write to file if hits critical geometry (TODO change to all geometry once file loading is working)
-
-        # pass
-        writeToFile(outFile, res)
+        hits, crits = countHits(mesh, records["face"])
+        stats["hit_critical"] += crits
+        stats["hit_obj"] += hits
+        if outFile:
+            writeHits(outFile, mesh, records["face"], records["u"], records["v"])
     bar.close()  # end bar
-    outFile.close()  # done writing to file
+    if outFile:
+        outFile.close()  # done writing to file
 
     if results is not None:
         return stats
 
 
-def multicoreIterateMap(objs, N) -> list[dict]:
-    division = N // CPU_COUNT
-    lock = mp.Manager().Lock()  # lock for prog. bars
-    # list of parameters to map to functions
-    divisionList = [
-        (i * division, (i + 1) * division, N, objs, None, None, i, lock)
-        for i in range(CPU_COUNT)
-    ]
+def multicoreIterateMap(
+    objs,
+    N,
+    engine=None,
+    mode="full",
+    emitter=None,
+    rel_err=None,
+    time_limit=None,
+    chunk=None,
+    checkpoint=None,
+    resume=False,
+    progress_log=None,
+) -> list[dict]:
+    """
+    Trace N rays on CPU_COUNT processes in a one-off TwobounceSession, see
+    TwobounceSession.run
+    Use a TwobounceSession directly to trace many jobs against the same geometry
+    :param objs: list of objects or TriangleMesh
+    :param N: number of rays (the maximum number of rays for a convergence driven run)
+    :param engine: intersection engine (default: see TwobounceSession)
+    :param mode: "full" writes every hit to ./output, "texture" only writes hit counts
+        per texture pixel to TEXTURE_FILE, "stats" only counts critical and object hits
+    :param emitter: source from Emitters for reproducible (and weighted) rays
+        (default: None, a PointSource with a random seed)
+    :param rel_err: stop once the 95% confidence interval of the hit_critical fraction
+        is within this relative error (default: None, trace all N rays)
+    :param time_limit: stop after this many seconds (default: None, no limit)
+    :param chunk: rays per task, None to adapt it to the measured throughput (default:
+        None)
+    :param checkpoint: file to save progress to (default: None)
+    :param resume: finish the run saved in checkpoint instead (default: False)
+    :param progress_log: file to append machine readable progress to (default: None)
+    :return: list of stats dictionaries, one per traced chunk
+    """
+    with TwobounceSession(objs, engine, mode) as session:
+        return session.run(
+            N,
+            emitter,
+            mode,
+            rel_err,
+            time_limit,
+            chunk,
+            checkpoint,
+            resume,
+            progress_log,
+        )
+
+
+def saveCheckpoint(filename: str, state: dict) -> None:
+    """
+    Write a checkpoint atomically (to a temporary file that then replaces filename)
+    :param filename: checkpoint file
+    :param state: run state, see TwobounceSession.run
+    """
+    with open(filename + ".tmp", "wb") as f:
+        pickle.dump(state, f)
+    os.replace(filename + ".tmp", filename)
+
+
+def loadCheckpoint(filename: str) -> dict:
+    """
+    :param filename: checkpoint file written by saveCheckpoint
+    :return: run state
+    """
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+_worker = {}  # per process state of pool workers, set by _initWorker
+
+
+def _initWorker(
+    shared, engine, counter, progress, rows, output, texture_size, barrier
+) -> None:
+    """
+    Pool initializer, attaches to the shared scene and traces one ray so the worker is
+    warm (numba compiled, BVH lists built) before the first job
+    :param shared: SharedMesh of the scene
+    :param engine: intersection engine
+    :param counter: shared mp.Value handing out worker numbers (used in the output file
+        names)
+    :param progress: shared array from Progress.progressCounters, the worker adds to its
+        own row
+    :param rows: shared array from Progress.progressRows, the worker claims its row of
+        progress in it
+    :param output: format of the output files, see OUTPUT
+    :param texture_size: pixels per side of the counts of "texture" jobs
+    :param barrier: shared mp.Barrier of all workers, see _flushTexture
+    """
+    # Ctrl-C reaches the whole group, the parent handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with counter.get_lock():
+        pid = counter.value
+        counter.value += 1
+    mp.util.Finalize(None, _releaseWorker, exitpriority=0)
+    objs = shared.attach()
+    _worker.update(
+        shared=shared,
+        objs=objs,
+        engine=engine,
+        pid=pid,
+        progress=partial(addProgress, progress, claimRow(rows)),
+        output=output,
+        texture_size=texture_size,
+        barrier=barrier,
+        # "texture" counts of the chunks traced since the last _flushTexture
+        texture={},
+    )
+    traceRays(objs, np.zeros(3), np.array([[0.0, 0.0, 1.0]]), engine)
+
+
+def _releaseWorker() -> None:
+    """
+    Run when a pool worker exits: drop the mesh (its arrays are views of the shared
+    block) before closing the block, SharedMemory cannot be closed while views of it are
+    alive
+    """
+    shared = _worker.get("shared")
+    _worker.clear()
+    if shared is not None:
+        shared.close()
+
+
+def _traceWorkerChunk(job: tuple, chunk: tuple[int, int]) -> tuple:
+    """
+    Pool task, trace one (b0, b1) range of rays of a job, appending hits to the worker's
+    output file
+    :param job: (mode, emitter, collect), with collect the hits are returned instead of
+        written and the "texture" counts are returned with the chunk's stats instead of
+        kept in the worker (see _flushTexture)
+    :return: (b0, b1, stats, seconds spent tracing, hits or None (text, or binary
+        records without the header), (worker number, length of its output file after
+        this chunk or None))
+    """
+    t0 = time.perf_counter()
+    mode, emitter, collect = job
+    w = _worker
+    args = (w["objs"], *chunk, w["engine"], mode, emitter)
+    hits = None
+    length = None
+    if mode == "full" and collect and w["output"] == "binary":
+        header = hitHeader(asMesh(w["objs"]).object_names)
+        outFile = io.BytesIO()
+        outFile.write(header)  # so records are appended without one
+        stats = traceChunk(*args, outFile, w["progress"], "binary")
+        hits = outFile.getvalue()[len(header) :]
+    elif mode == "full" and collect:
+        outFile = io.StringIO()
+        stats = traceChunk(*args, outFile, w["progress"])
+        hits = outFile.getvalue()
+    elif mode == "full":
+        binary = w["output"] == "binary"
+        with open(
+            OUTPUT_FILES[w["output"]].format(w["pid"]), "ab" if binary else "a"
+        ) as outFile:
+            stats = traceChunk(*args, outFile, w["progress"], w["output"])
+            length = outFile.tell()
+    else:
+        stats = traceChunk(*args, None, w["progress"], texture_size=w["texture_size"])
+        if mode == "texture" and not collect:
+            addTextureCounts(w["texture"], *stats.pop("texture"))
+    return chunk[0], chunk[1], stats, time.perf_counter() - t0, hits, (w["pid"], length)
+
+
+def _flushTexture(_) -> tuple:
+    """
+    Pool task that every worker takes one of at once (each waits at the barrier until
+    all workers hold one), hands over the "texture" counts the worker kept since the
+    last flush
+    :return: (index, counts, texture size) of the pixels hit, see traceChunk
+    """
+    _worker["barrier"].wait()
+    counts, _worker["texture"] = _worker["texture"], {}
+    return (*sparseTextureCounts(counts), _worker["texture_size"])
 
-    with mp.Pool(processes=CPU_COUNT) as pool:
-        res = pool.starmap(iterateStartVecs, divisionList)
 
-    printf()
-    return res
+class TwobounceSession:
+    """
+    Warm pool of workers with the scene resident in shared memory, for many trace jobs
+    against the same geometry (parameter scans). Geometry is packed, its BVHs built and
+    published once, and the workers are started once, each job only sends ray ranges and
+    the emitter to them
+
+        with TwobounceSession.fromObj("./FourCubes.obj") as session:
+            for seed in range(10):
+                stats = session.run(100_000, SobolSource(seed=seed))
+                print(weightedFraction(stats, "hit_critical"))
+    """
+
+    def __init__(
+        self,
+        objs,
+        engine=None,
+        mode="full",
+        processes=None,
+        output=None,
+        texture_size=TEXTURE_SIZE,
+    ):
+        """
+        :param objs: list of objects or TriangleMesh
+        :param engine: intersection engine (default: "numba" with several workers so
+            resident memory stays flat as workers are added, see SharedMesh, ENGINE with
+            one)
+        :param mode: default mode of the jobs, "full" or "stats" (decides which BVHs are
+            built up front)
+        :param processes: number of workers (default: CPU_COUNT)
+        :param output: format of the hits of "full" jobs, "binary" or "text" (default:
+            OUTPUT)
+        :param texture_size: pixels per side of the hit counts of "texture" jobs
+            (default: TEXTURE_SIZE)
+        """
+        self.processes = processes or CPU_COUNT
+        if engine is None and self.processes > 1:
+            # numba traverses the shared BVH arrays, the "bvh" engine copies them into
+            # lists in every worker
+            engine = "numba"
+        if (engine or ENGINE) != getEngine(engine):
+            print(f"numba is not installed, using the {getEngine(engine)} engine")
+        self.engine = engine
+        self.mode = mode
+        self.output = output or OUTPUT
+        self.texture_size = texture_size
+        # rays per second of one worker, smoothed over the chunks traced so far
+        self.rate = None
+        self.mesh = prepareMesh(objs, engine, mode)
+        self.shared = SharedMesh(self.mesh)
+        self.progress = progressCounters(self.processes)
+        self.pool = mp.Pool(
+            self.processes,
+            _initWorker,
+            (
+                self.shared,
+                engine,
+                mp.Value("i", 0),
+                self.progress,
+                progressRows(self.processes),
+                self.output,
+                texture_size,
+                mp.Barrier(self.processes),
+            ),
+        )
+        # the pool replaces workers that die, see _nextResult
+        self._pids = {p.pid for p in self.pool._pool}
+
+    @classmethod
+    def fromObj(
+        cls,
+        filename: str,
+        engine=None,
+        mode="full",
+        processes=None,
+        output=None,
+        texture_size=TEXTURE_SIZE,
+    ) -> "TwobounceSession":
+        """
+        :param filename: path to .obj file
+        :return: session over the geometry in filename
+        """
+        return cls(
+            TriangleMesh.fromObj(filename),
+            engine,
+            mode,
+            processes,
+            output,
+            texture_size,
+        )
+
+    def run(
+        self,
+        N,
+        emitter=None,
+        mode=None,
+        rel_err=None,
+        time_limit=None,
+        chunk=None,
+        checkpoint=None,
+        resume=False,
+        progress_log=None,
+    ) -> list[dict]:
+        """
+        Trace one job of N rays, chunks of rays are handed out to idle workers (see
+        chunks)
+        With rel_err or time_limit the run is convergence driven, chunk stats are then
+        reduced in ray order, so for a given seed and rel_err the run stops after the
+        same number of rays whatever the core count (a time limit is not reproducible).
+        Either way the number of rays used is printed. Hits then come back with their
+        chunk and only those of the counted chunks are written, in ray order, to the
+        output file of worker 0, chunks still in flight when the run stops are traced
+        to the end but dropped
+        With a checkpoint file, the finished chunks (their stats and how far each output
+        file was written) and the emitter with its seed are saved every
+        CHECKPOINT_SECONDS, on errors and at the end.
+        A resumed run traces only the missing chunks and gives the same stats and output
+        as an uninterrupted one
+        :param N: number of rays (the maximum number of rays for a convergence driven
+            run)
+        :param emitter: source from Emitters, gives the source position and ray
+            distribution (default: None, a PointSource at the origin with a random seed)
+        :param mode: "full" writes every hit to ./output in the session's output format
+            (replacing the previous job's files), "texture" sums the hits per object,
+            bounce and texture pixel in the workers and writes only the totals to
+            TEXTURE_FILE (also replacing the previous job's files), "stats" only counts
+            critical and object hits (default: the session's mode). "texture" counts
+            stay in the workers until the job ends, unless the run is convergence driven
+            or checkpointed: chunks then return the pixels they hit so only the chunks
+            counted (or saved) add to the images
+        :param rel_err: stop once the 95% confidence interval of the hit_critical
+            fraction is within this relative error (default: None)
+        :param time_limit: stop after this many seconds (default: None)
+        :param chunk: rays per task, None to adapt it to the measured throughput
+            (Emitters.CHUNK for a convergence driven run)
+        :param checkpoint: file to save progress to (default: None, no checkpoints)
+        :param resume: continue the run saved in checkpoint (if it exists), N, emitter,
+            mode, rel_err and chunk are then taken from the checkpoint
+        :param progress_log: file to append progress (rays, hits, rays/sec, ETA, rays
+            per worker) to as JSON lines, see Progress.ProgressReporter (default: None)
+        :return: list of stats dictionaries, one per traced chunk in ray order
+        """
+        state = {
+            "digest": self.mesh.digest(),
+            "N": N,
+            "emitter": emitter or PointSource(),
+            "mode": mode or self.mode,
+            "rel_err": rel_err,
+            "chunk": chunk,
+            # first ray -> (one past the last ray, stats) of every finished chunk
+            "chunks": {},
+            "output": self.output,
+            # worker number -> length of its output file after its last finished chunk
+            "written": {},
+            # "texture" counts of the chunks counted so far (removed from their stats)
+            "texture": {},
+            "texture_size": self.texture_size,
+        }
+        if resume and checkpoint and os.path.exists(checkpoint):
+            state = loadCheckpoint(checkpoint)
+            if state["digest"] != self.mesh.digest():
+                raise ValueError(f"{checkpoint} was saved for different geometry")
+            traced = sum(b1 - b0 for b0, (b1, _) in state["chunks"].items())
+            print(
+                f"Resuming from {checkpoint}, "
+                f"{traced} of {state['N']} rays already traced"
+            )
+        N, mode, rel_err, chunk = (
+            state["N"],
+            state["mode"],
+            state["rel_err"],
+            state["chunk"],
+        )
+        converge = rel_err is not None or time_limit is not None
+        # hits and "texture" counts come back with their chunk when chunks may be left
+        # out of the result, and "texture" counts also when chunks are saved without the
+        # rest
+        job = (
+            mode,
+            state["emitter"],
+            converge or mode == "texture" and bool(checkpoint),
+        )
+        if mode == "full" and state.get("output", "text") != self.output:
+            raise ValueError(
+                f"{checkpoint} was written with {state.get('output', 'text')} output"
+            )
+        if (
+            mode == "texture"
+            and state.get("texture_size", self.texture_size) != self.texture_size
+        ):
+            raise ValueError(f"{checkpoint} was written with a different texture size")
+        if mode in ["full", "texture"]:
+            # drop hits of chunks that never finished (or of an earlier run when not
+            # resuming), also in the files of workers beyond the current process count
+            # and in files of the other output format, and the counts of an earlier
+            # "texture" run
+            if os.path.exists(TEXTURE_FILE):
+                os.remove(TEXTURE_FILE)
+            for output, pattern in OUTPUT_FILES.items():
+                written = (
+                    state["written"] if mode == "full" and output == self.output else {}
+                )
+                prefix, suffix = pattern.split("{}")
+                pids = set(written)
+                for filename in glob.glob(pattern.format("*")):
+                    pid = filename[len(prefix) : -len(suffix)]
+                    if pid.isdigit():
+                        pids.add(int(pid))
+                for pid in pids:
+                    if written.get(pid):
+                        with open(pattern.format(pid), "ab") as f:
+                            f.truncate(written[pid])
+                    elif os.path.exists(pattern.format(pid)):
+                        os.remove(pattern.format(pid))
+        if converge:
+            chunk = chunk or CHUNK
+        if mode == "texture" and not job[2]:
+            self._collectTexture()  # drop counts an interrupted job left in the workers
+
+        done = state["chunks"]
+        replay = [
+            (b0, b1, stats, None, None) for b0, (b1, stats) in sorted(done.items())
+        ]
+        gaps = []  # ray ranges not traced yet
+        b0 = 0
+        for c0, c1, *_ in replay + [(N, N)]:
+            if c0 > b0:
+                gaps.append((b0, c0))
+            b0 = max(b0, c1)
+
+        res = []
+        total = {}
+        # finished chunks of a convergence driven run by first ray, waiting for the ones
+        # before
+        ready = {}
+        next_ray = 0
+        t0 = last_save = time.time()
+        initial = sum(b1 - b0 for b0, b1, *_ in replay)
+        outFile = None
+        if converge and mode == "full":
+            # the parent writes the hits of the counted chunks, so chunks still in
+            # flight when the run stops leave nothing behind
+            binary = self.output == "binary"
+            outFile = open(OUTPUT_FILES[self.output].format(0), "ab" if binary else "a")
+            if binary and outFile.tell() == 0:
+                outFile.write(hitHeader(self.mesh.object_names))
+        reporter = ProgressReporter(self.progress, N, initial, log=progress_log).start()
+        tasks = self._traceGaps(job, gaps, chunk)
+        converged = False
+        try:
+            for b0, b1, stats, hits, written in itertools.chain(replay, tasks):
+                if not converge:
+                    if written is not None:  # newly traced
+                        done[b0] = (b1, stats)
+                        if written[1] is not None:
+                            state["written"][written[0]] = written[1]
+                    self._countTexture(state, stats)
+                else:
+                    ready[b0] = (b1, stats, hits, written is not None)
+                    # check after every chunk, in ray order
+                    while next_ray in ready and not converged:
+                        c0 = next_ray
+                        next_ray, stats, hits, new = ready.pop(c0)
+                        if new:  # only counted chunks are saved, with their hits
+                            done[c0] = (next_ray, stats)
+                        if hits is not None:
+                            outFile.write(hits)
+                            outFile.flush()
+                            state["written"][0] = outFile.tell()
+                        self._countTexture(state, stats)
+                        res.append(stats)
+                        mergeStats(total, stats)
+                        converged = (
+                            rel_err is not None and relativeError(total) <= rel_err
+                        )
+                    reporter.postfix = f"rel. err {relativeError(total):.3g}"
+                if (
+                    checkpoint
+                    and written is not None
+                    and time.time() - last_save >= CHECKPOINT_SECONDS
+                ):
+                    saveCheckpoint(checkpoint, state)
+                    last_save = time.time()
+                if converge and (
+                    converged
+                    or time_limit is not None
+                    and time.time() - t0 >= time_limit
+                ):
+                    break
+            # waits for the chunks still in flight, their results are dropped
+            tasks.close()
+        except BaseException:
+            # when the error came from outside chunks, waits for the chunks in flight
+            tasks.close()
+            if checkpoint:
+                saveCheckpoint(checkpoint, state)
+            raise
+        finally:
+            reporter.stop()
+            if outFile:
+                outFile.close()
+        if checkpoint:
+            saveCheckpoint(checkpoint, state)
+        if mode == "texture":
+            if not job[2]:
+                self._countTexture(state, {"texture": self._collectTexture()})
+            saveTextures(
+                TEXTURE_FILE,
+                state["texture"],
+                self.mesh.object_names,
+                self.texture_size,
+            )
+        if converge:
+            print(
+                f"Used {total.get('num_rays', 0)} of {N} rays, "
+                f"relative error {relativeError(total):.3g}"
+            )
+            return res
+        return [done[b0][1] for b0 in sorted(done)]
+
+    def _countTexture(self, state: dict, stats: dict) -> None:
+        """
+        Move the "texture" counts of a chunk that is counted in the result into the
+        run's total, so only one set of images is kept (chunks of a resumed run that
+        were counted before carry none)
+        """
+        if "texture" in stats:
+            addTextureCounts(state["texture"], *stats.pop("texture"))
+
+    def _collectTexture(self) -> tuple:
+        """
+        :return: (index, counts, texture size) of the "texture" counts kept in the
+            workers, which are reset
+        """
+        parts = self.pool.map(_flushTexture, range(self.processes), chunksize=1)
+        return (*mergeTextureCounts(parts), self.texture_size)
+
+    def _traceGaps(self, job, gaps, chunk=None):
+        """
+        :param gaps: list of (n0, n) ray ranges
+        :return: generator over chunks of every range, see chunks
+        """
+        for n0, n in gaps:
+            yield from self.chunks(job, n0, n, chunk)
+
+    def chunks(self, job, n0, n, chunk=None, target=CHUNK_SECONDS):
+        """
+        Work queue over the pool, ray ranges are handed out as workers become free (two
+        tasks per worker in flight) and every ray from n0 to n is traced exactly once
+        Without a fixed chunk size, chunks are sized to take about target seconds at the
+        throughput measured so far, and shrink towards the end of the run so the last
+        tasks finish together. They then end on multiples of Emitters.CHUNK, the
+        emitters generate whole chunks of rays and a task ending inside one would leave
+        the next task to generate it again
+        Closing the generator early stops handing out chunks and waits for the ones in
+        flight, on Ctrl-C or when a worker dies the pool is terminated instead (the
+        session can then only be closed)
+        :param job: (mode, emitter, collect), see _traceWorkerChunk
+        :param n0: first ray
+        :param n: one past the last ray
+        :param chunk: fixed rays per task, None to adapt (starting at MIN_CHUNK)
+        :param target: seconds per task when adapting (default: CHUNK_SECONDS)
+        :return: generator of (b0, b1, stats, hits, (worker, length of its output file))
+            in the order chunks finish, see _traceWorkerChunk
+        """
+        done = queue.Queue()
+        size = chunk or MIN_CHUNK
+        b0 = n0
+        pending = 0
+        try:
+            while True:
+                while pending < 2 * self.processes and b0 < n:
+                    if chunk is None and self.rate is not None:
+                        size = max(
+                            MIN_CHUNK,
+                            min(
+                                int(self.rate * target),
+                                (n - b0) // (2 * self.processes),
+                            ),
+                        )
+                    b1 = min(n, b0 + size if chunk else (b0 + size) // CHUNK * CHUNK)
+                    self.pool.apply_async(
+                        _traceWorkerChunk,
+                        (job, (b0, b1)),
+                        callback=done.put,
+                        error_callback=done.put,
+                    )
+                    pending += 1
+                    b0 = b1
+                if not pending:
+                    return
+                result = self._nextResult(done)
+                pending -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                c0, c1, stats, seconds, hits, written = result
+                if seconds > 0:
+                    r = (c1 - c0) / seconds
+                    self.rate = r if self.rate is None else 0.7 * self.rate + 0.3 * r
+                yield c0, c1, stats, hits, written
+        except (KeyboardInterrupt, ChildProcessError):
+            self.pool.terminate()  # the chunks in flight may never finish
+            pending = 0
+            raise
+        finally:
+            for _ in range(pending):
+                self._nextResult(done)
+
+    def _nextResult(self, done: queue.Queue):
+        """
+        Wait for the next finished task of chunks. The pool silently replaces a worker
+        that dies (e.g. killed by the OOM killer) and the task it held never finishes,
+        so the workers are checked before every wait and every POLL_SECONDS while
+        waiting
+        :param done: queue the task callbacks put their results in
+        :return: result of the task, or the exception it raised
+        """
+        while True:
+            workers = self.pool._pool
+            if {p.pid for p in workers} != self._pids or any(
+                p.exitcode is not None for p in workers
+            ):
+                # a worker killed while it waited for a task leaves the task queue
+                # locked, which Pool.terminate would wait for forever
+                try:
+                    self.pool._inqueue._rlock.release()
+                except ValueError:  # not locked
+                    pass
+                raise ChildProcessError(
+                    "a pool worker died, the rays it was tracing are lost"
+                )
+            try:
+                return done.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                pass
+
+    def traceRange(self, job, n0, n) -> tuple[dict, str | bytes | None]:
+        """
+        Trace rays n0 to n of a job on all workers
+        :param job: (mode, emitter, collect), see _traceWorkerChunk ("texture" counts
+            are always kept in the workers and returned once, in the merged stats)
+        :return: (merged stats, hits as text or binary records without the header, None
+            if nothing was collected)
+        """
+        total = {}
+        hits = []
+        if job[0] == "texture":
+            job = (job[0], job[1], False)
+            self._collectTexture()  # drop counts an interrupted job left in the workers
+        for _, _, stats, chunkHits, _ in self.chunks(job, n0, n):
+            mergeStats(total, stats)
+            if chunkHits is not None:
+                hits.append(chunkHits)
+        if job[0] == "texture":
+            total["texture"] = self._collectTexture()
+        if not hits:
+            return total, None
+        return total, (b"" if isinstance(hits[0], bytes) else "").join(hits)
+
+    def close(self) -> None:
+        """
+        Stop the workers and release the shared geometry
+        """
+        self.pool.close()
+        self.pool.join()
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return (
+            f"[TwobounceSession: {self.mesh}, {self.processes} workers, "
+            f"{getEngine(self.engine)} engine]"
+        )
 
 
 # objs, ns, results=None, pid=0)
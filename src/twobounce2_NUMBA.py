@@ -1,295 +1,459 @@
-import copy
-import functools
 import math
-import multiprocessing as mp
-import time
-from functools import partial
-from pprint import pprint
-import random as r
-from math import sin, cos
-from GeometricObjects import *
-from tqdm import tqdm
 import numpy as np
-from numba import jit, njit
-
-# import numpy as np
-
-CPU_COUNT = mp.cpu_count()
-
-# pprint("")
-
-printf = print
+from tqdm import tqdm
 
+try:
+    from numba import njit
 
-def print(s=""):
-    """
-    Perhaps bad practice, but I do not care. Override print() function to print timestamp at the front.
-    :param s: String to print
-    :return: void
-    """
-    st = time.gmtime(time.time())
-    st = time.strftime("%H:%M:%S", st)
-    printf(f"{st} - {s}")
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # keep the module importable, twobounce2 falls back to the python engines
+    NUMBA_AVAILABLE = False
 
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
-def initalize():
-    printf(
-        r"""
- ___  ____                                   ____  _____
-|__ \|  _ \                                 |___ \|  __ \
-   ) | |_) | ___  _   _ _ __   ___ ___       __) | |  | |
-  / /|  _ < / _ \| | | | '_ \ / __/ _ |      |__ <| |  | |
- / /_| |_) | (_) | |_| | | | | (_|  __/      ___) | |__| |
-|____|____/ \___/ \__,_|_| |_|\___\___|     |____/|_____/
-Luc Barrett, Nov. 2022
-        """
-    )
-    print(f"CPU Core Count: {CPU_COUNT}\n")
 
+from TriangleMesh import TriangleMesh
 
-class ObjLoader:
-    def __init__(self, path):
-        """
-        :param path: Path to folder containing object files. Ex: "./"
-        """
-        self.path = path
+"""
+Compiled twobounce engine
 
-    def load(self, filename) -> tuple[list[TriObject], list[Triangle]]:
-        """
-        :param filename: Name of file in path, ex: test_file.obj
-        :return: Tuple containing list of objects and full list of triangles
-        """
-        verticies = []
-        objects = []
-        triangles = []
-        normals = []
-        texture_verticies = []
-        with open(self.path + filename, "r") as f:
-            curObject = None
-            for line in f.readlines():
-                if line[0] in ["o", "g"]:
-                    name = line.split(" ")[1].strip("\n")
-                    args = name.split("-")
+Ray generation, BVH traversal against the packed triangle arrays, reflection and stats
+accumulation for a whole block of rays run inside one @njit function. Functions are
+compiled with nogil (so blocks can run from threads) and cache=True (so the compiled
+code is kept in __pycache__ between runs)
+"""
 
-                    # print(f"Loading {name}")
-                    curObject = TriObject(name, [], [], "crit" in args)
-                    objects.append(curObject)
-                if line[0] == "#":
+EPS = 0.000001  # same tolerance as Triangle.intersect
+STACK_SIZE = 128  # traversal stack, closestHit raises if a BVH is deeper than this
+BLOCK = 7500  # rays per compiled call, progress bars are updated in between
+
+
+@njit(nogil=True, cache=True)
+def _slabs(lo, hi, st, inv):
+    tmin = 0.0
+    tmax = np.inf
+    for a in range(3):
+        t1 = (lo[a] - st[a]) * inv[a]
+        t2 = (hi[a] - st[a]) * inv[a]
+        if t1 > t2:
+            t1, t2 = t2, t1
+        if t1 > tmin:
+            tmin = t1
+        if t2 < tmax:
+            tmax = t2
+        if tmin > tmax:
+            return np.inf
+    return tmin
+
+
+@njit(nogil=True, cache=True)
+def closestHit(
+    st,
+    d,
+    node_min,
+    node_max,
+    node_right,
+    node_start,
+    node_count,
+    v0,
+    edge1,
+    edge2,
+    transforms,
+    ignore,
+):
+    """
+    Iterative closest hit BVH traversal, see BVH.intersect
+    :param transforms: BVH ordered ray transforms (see BVH.useTransforms), empty to use
+        Moller-Trumbore
+    :param ignore: BVH slot of a triangle to skip (the one the ray starts on), -1 for
+        none
+    :return: (t, u, v, k) where k indexes the BVH ordered triangle arrays, -1 on a miss
+    """
+    inv = np.empty(3)
+    for a in range(3):
+        inv[a] = 1.0 / d[a] if d[a] != 0 else math.copysign(1e300, d[a])
+    best_t = np.inf
+    best_u = np.nan
+    best_v = np.nan
+    best_k = -1
+    if len(v0) == 0 or _slabs(node_min[0], node_max[0], st, inv) == np.inf:
+        return best_t, best_u, best_v, best_k
+
+    stack = np.empty(STACK_SIZE, dtype=np.int64)
+    entry = np.empty(STACK_SIZE)
+    stack[0] = 0
+    entry[0] = 0.0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        if entry[top] >= best_t:
+            continue
+        count = node_count[node]
+        if count > 0:
+            s = node_start[node]
+            for k in range(s, s + count):
+                if k == ignore:
                     continue
-                if line[0] == "v" and line[1] == " ":
-                    split = line.split(" ")
-                    verticies.append(
-                        Vector(float(split[1]), float(split[2]), float(split[3]))
-                    )
-                    curObject.points.append(
-                        Vector(float(split[1]), float(split[2]), float(split[3]))
-                    )
-                if line[0] == "v" and line[1] == "n":
-                    split = line.split(" ")
-                    normals.append(
-                        Vector(float(split[1]), float(split[2]), float(split[3]))
+                if len(transforms):
+                    m = transforms[k]
+                    det = m[2, 0] * d[0] + m[2, 1] * d[1] + m[2, 2] * d[2]
+                    if abs(det) < EPS:
+                        continue
+                    t = (
+                        -(m[2, 0] * st[0] + m[2, 1] * st[1] + m[2, 2] * st[2] + m[2, 3])
+                        / det
                     )
-                if line[0] == "v" and line[1] == "t":
-                    split = line.split(" ")
-                    texture_verticies.append([float(split[1]), float(split[2])])
-                if line[0] == "f":
-                    split = line.split(" ")
-                    v1 = split[1].split("/")
-                    v2 = split[2].split("/")
-                    v3 = split[3].split("/")
-                    triangle = Triangle(
-                        (
-                            verticies[int(v1[0]) - 1],
-                            verticies[int(v2[0]) - 1],
-                            verticies[int(v3[0]) - 1],
-                        )
-                    )
-                    triangle.textureCoords = (
-                        texture_verticies[int(v1[1]) - 1],
-                        texture_verticies[int(v2[1]) - 1],
-                        texture_verticies[int(v3[1]) - 1],
-                    )
-                    triangle.normal = normals[int(v1[2]) - 1]
-                    curObject.triangles.append(triangle)
-                    triangles.append(triangle)
-        # print(f"{len(triangles)} polygons loaded")
-        return objects, triangles
-
-
-class Hit:
-    def __init__(
-        self,
-        start: Vector,
-        vec: Vector,
-        t: float,
-        tri: Triangle,
-        obj: TriObject,
-        didHit: bool,
-    ):
-        self.start = start
-        self.vec = vec
-        self.t = t
-        self.tri = tri
-        self.obj = obj
-        self.hit = didHit
-        self.n = None
-        # triangle coordinates
-        self.u = None
-        self.v = None
-        self.hitDict = {
-            "Start point": self.start,
-            "Direction Vector": self.vec,
-            "t": self.t,
-            "Hit object": self.obj,
-            # "Hit triangle"    : self.tri
-        }
-        if self.obj:
-            self.hitDict["Collison"] = self.coord()
-
-    def coord(self):
-        return self.vec.calcCoord(self.start, self.t)
-
-    def __bool__(self):
-        if self.hit is None:
-            return False
-        return self.hit
-
-    def __repr__(self):
-        if self.obj:
-            return f"<HitInfo - hit {self.obj.name}>"
+                    if t < EPS or t >= best_t:
+                        continue
+                    hx = st[0] + t * d[0]
+                    hy = st[1] + t * d[1]
+                    hz = st[2] + t * d[2]
+                    u = m[0, 0] * hx + m[0, 1] * hy + m[0, 2] * hz + m[0, 3]
+                    if u < 0.0 or u > 1.0:
+                        continue
+                    v = m[1, 0] * hx + m[1, 1] * hy + m[1, 2] * hz + m[1, 3]
+                    if v < 0.0 or u + v > 1.0:
+                        continue
+                    best_t = t
+                    best_u = u
+                    best_v = v
+                    best_k = k
+                    continue
+                px = d[1] * edge2[k, 2] - d[2] * edge2[k, 1]
+                py = d[2] * edge2[k, 0] - d[0] * edge2[k, 2]
+                pz = d[0] * edge2[k, 1] - d[1] * edge2[k, 0]
+                det = edge1[k, 0] * px + edge1[k, 1] * py + edge1[k, 2] * pz
+                if abs(det) < EPS:
+                    continue
+                inv_det = 1.0 / det
+                tx = st[0] - v0[k, 0]
+                ty = st[1] - v0[k, 1]
+                tz = st[2] - v0[k, 2]
+                u = (tx * px + ty * py + tz * pz) * inv_det
+                if u < 0.0 or u > 1.0:
+                    continue
+                qx = ty * edge1[k, 2] - tz * edge1[k, 1]
+                qy = tz * edge1[k, 0] - tx * edge1[k, 2]
+                qz = tx * edge1[k, 1] - ty * edge1[k, 0]
+                v = (d[0] * qx + d[1] * qy + d[2] * qz) * inv_det
+                if v < 0.0 or u + v > 1.0:
+                    continue
+                t = (edge2[k, 0] * qx + edge2[k, 1] * qy + edge2[k, 2] * qz) * inv_det
+                if t < EPS or t >= best_t:
+                    continue
+                best_t = t
+                best_u = u
+                best_v = v
+                best_k = k
+            continue
+        if top + 2 > STACK_SIZE:  # bounds checks are off in compiled code
+            raise RuntimeError("BVH is deeper than twobounce2_NUMBA.STACK_SIZE")
+        left = node + 1
+        right = node_right[node]
+        t_left = _slabs(node_min[left], node_max[left], st, inv)
+        t_right = _slabs(node_min[right], node_max[right], st, inv)
+        # push the far child first so the near child is popped next
+        if t_left <= t_right:
+            if t_right < best_t:
+                stack[top] = right
+                entry[top] = t_right
+                top += 1
+            if t_left < best_t:
+                stack[top] = left
+                entry[top] = t_left
+                top += 1
         else:
-            return f"<HitInfo - hit None>"
+            if t_left < best_t:
+                stack[top] = left
+                entry[top] = t_left
+                top += 1
+            if t_right < best_t:
+                stack[top] = right
+                entry[top] = t_right
+                top += 1
+    return best_t, best_u, best_v, best_k
+
+
+@njit(nogil=True, cache=True)
+def traceRays(
+    starts,
+    dirs,
+    node_min,
+    node_max,
+    node_right,
+    node_start,
+    node_count,
+    tri_index,
+    v0,
+    edge1,
+    edge2,
+    transforms,
+    unit_normals,
+    critical,
+):
+    """
+    Follow each ray for two bounces
+    :param starts: (n, 3) ray starts
+    :param dirs: (n, 3) ray directions
+    :return: (hit_obj, hit_critical, faces, us, vs) where faces, us and vs are (n, 2)
+        per bounce hit arrays, faces is -1 where there was no hit
+    """
+    n = len(dirs)
+    faces = np.full((n, 2), -1, dtype=np.int64)
+    us = np.zeros((n, 2))
+    vs = np.zeros((n, 2))
+    hit_obj = 0
+    hit_critical = 0
+    d = np.empty(3)
+    p = np.empty(3)
+    for r in range(n):
+        start = starts[r]
+        d[:] = dirs[r]
+        t, u, v, k = closestHit(
+            start,
+            d,
+            node_min,
+            node_max,
+            node_right,
+            node_start,
+            node_count,
+            v0,
+            edge1,
+            edge2,
+            transforms,
+            -1,
+        )
+        if k < 0:
+            continue
+        f = tri_index[k]
+        faces[r, 0] = f
+        us[r, 0] = u
+        vs[r, 0] = v
+        hit_obj += 1
+        crit = critical[f]
+
+        # reflect about the face normal and bounce again from the hit point, skipping
+        # the face it left
+        nrm = unit_normals[f]
+        scale = 2 * (d[0] * nrm[0] + d[1] * nrm[1] + d[2] * nrm[2])
+        for a in range(3):
+            p[a] = start[a] + d[a] * t
+            d[a] = d[a] - nrm[a] * scale
+        t, u, v, k = closestHit(
+            p,
+            d,
+            node_min,
+            node_max,
+            node_right,
+            node_start,
+            node_count,
+            v0,
+            edge1,
+            edge2,
+            transforms,
+            k,
+        )
+        if k >= 0:
+            f = tri_index[k]
+            faces[r, 1] = f
+            us[r, 1] = u
+            vs[r, 1] = v
+            crit = crit or critical[f]
+        if crit:
+            hit_critical += 1
+    return hit_obj, hit_critical, faces, us, vs
+
+
+@njit(nogil=True, cache=True)
+def traceBlock(
+    seed,
+    n,
+    start,
+    node_min,
+    node_max,
+    node_right,
+    node_start,
+    node_count,
+    tri_index,
+    v0,
+    edge1,
+    edge2,
+    transforms,
+    unit_normals,
+    critical,
+):
+    """
+    Emit n rays from start (same distribution as iterateStartVecs) and follow each for
+    two bounces
+    :param seed: 32 bit seed for this block's random numbers, see blockSeed
+    :return: see traceRays
+    """
+    np.random.seed(seed)
+    starts = np.empty((n, 3))
+    dirs = np.empty((n, 3))
+    for r in range(n):
+        theta = np.random.random() * np.pi
+        phi = np.random.random() * 2 * np.pi
+        starts[r] = start
+        dirs[r, 0] = math.cos(phi) * math.sin(theta)
+        dirs[r, 1] = math.sin(theta) * math.sin(phi)
+        dirs[r, 2] = math.cos(theta)
+    return traceRays(
+        starts,
+        dirs,
+        node_min,
+        node_max,
+        node_right,
+        node_start,
+        node_count,
+        tri_index,
+        v0,
+        edge1,
+        edge2,
+        transforms,
+        unit_normals,
+        critical,
+    )
 
 
-def checkIntersections(objects: list[TriObject], st: Vector, ray: Vector) -> Hit:
+def traceArrays(mesh: TriangleMesh) -> tuple:
     """
-    Finds first intersection of ray starting at st with any object
-
-    Future optimization options:
-        - Check for bounding box intersection first
-        - Organize objects into tree (?)
-    :param objects: list of Objects
-    :param st: starting Vector
-    :param ray: direction Vector
-    :return: Hit class containing hit info
+    :param mesh: TriangleMesh
+    :return: mesh and BVH arrays in the order traceRays and traceBlock expect them after
+        the rays
     """
-    min_t = math.inf
-    lastVec = None
-    u = None
-    v = None
-    hitInfo = [st, ray, None, None, None, None]
-    for obj in objects:
-        for tri in obj.triangles:
-            hit, vec = tri.intersect(st, ray)
-            if hit and vec.x < min_t:
-                min_t = vec.x
-                hitInfo[2] = min_t
-                hitInfo[3] = tri
-                hitInfo[4] = obj
-                hitInfo[5] = hit
-                u = vec.u
-                v = vec.v
-    h = Hit(*hitInfo)
-    h.u = u
-    h.v = v
-    return h
+    b = mesh.bvh
+    return (
+        b.node_min,
+        b.node_max,
+        b.node_right,
+        b.node_start,
+        b.node_count,
+        b.tri_index,
+        b.v0,
+        b.edge1,
+        b.edge2,
+        b.transforms,
+        mesh.unit_normals,
+        mesh.critical,
+    )
 
 
-def twobounce(objects: list[TriObject], st: Vector, ray: Vector) -> tuple[Hit, Hit]:
+def trace(
+    mesh: TriangleMesh, starts, dirs
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    :param objects: List of objects
-    :param st: Start of ray
-    :param ray: Direction of ray
-    :return: (res1, res2) where res1 is Hit information of first collision, res2 is Hit information of second collision
+    Compiled version of twobounce2.traceRays
+    :param mesh: TriangleMesh
+    :param starts: (n, 3) ray starts
+    :param dirs: (n, 3) ray directions
+    :return: (faces, us, vs), (n, 2) arrays with the face, u and v of each bounce, face
+        is -1 for no hit
     """
-    objects = copy.copy(objects)
-    # One bounce
-    result = checkIntersections(objects, st, ray)
-    if not result.hit:
-        return (result, Hit(None, None, None, None, None, False))
-    coords = result.coord()  # coords becomes new start
+    dirs = np.ascontiguousarray(dirs, dtype=np.float64).reshape(-1, 3)
+    starts = np.ascontiguousarray(np.broadcast_to(starts, dirs.shape), dtype=np.float64)
+    _, _, faces, us, vs = traceRays(starts, dirs, *traceArrays(mesh))
+    return faces, us, vs
 
-    # two bounce
-    n = result.tri.normal  # normal vector to triangle
-    # new_r = ray - n * 2 * (ray.dot(n))  # new direction vector from reflection
-    new_r = ray - n * ((ray * 2).dot(n) / (abs(n) * abs(n)))
-    # objects.remove(result.obj)  # remove originating structure from objects to avoid floating point error causing hit
-    result2 = checkIntersections(objects, coords, new_r)
-    return result, result2
 
-
-def linspace(start, stop, n):
+def bvhArrays(mesh: TriangleMesh) -> tuple:
     """
-    Copy of numpys linspace, with integer divide
-    :param start: start value
-    :param stop: end value
-    :param n: how many divisions between start and end
-    :return: generator for values (can be casted to list)
+    :param mesh: TriangleMesh
+    :return: BVH arrays in the order closestHit expects them
     """
-    if n == 1:
-        yield stop
-        return
-    h = (stop - start) // (n - 1)
-    for i in range(n):
-        yield start + h * i
+    b = mesh.bvh
+    return (
+        b.node_min,
+        b.node_max,
+        b.node_right,
+        b.node_start,
+        b.node_count,
+        b.v0,
+        b.edge1,
+        b.edge2,
+        b.transforms,
+    )
 
 
-def calcTextureCoordinate(u, v, w, textureCoords):
+def intersect(
+    mesh: TriangleMesh, st, ray, ignore=-1
+) -> tuple[float, float, float, int]:
     """
-    Take in u,v,w for collision and calculate the coordinate in the texture file for the hit
-
+    Closest hit of a single ray, same interface as BVH.intersect
+    :param mesh: TriangleMesh
+    :param st: ray start, sequence of 3 floats
+    :param ray: ray direction, sequence of 3 floats
+    :param ignore: index of a face to skip, -1 for none
+    :return: (t, u, v, face index), index is -1 on a miss
     """
-    coord = [w, u, v]
-    textureCoords = np.asarray(textureCoords)
-    result = np.dot(coord, textureCoords)
-    return result
+    t, u, v, k = closestHit(
+        np.asarray(st, dtype=np.float64),
+        np.asarray(ray, dtype=np.float64),
+        *bvhArrays(mesh),
+        mesh.bvh.tri_slot[ignore] if ignore >= 0 else -1,
+    )
+    if k < 0:
+        return math.inf, math.nan, math.nan, -1
+    return t, u, v, int(mesh.bvh.tri_index[k])
 
 
-def writeToFile(file, res: list[Hit, Hit]):
-    for i, hit in enumerate(res):
-        if not hit.hit:
-            return
-        else:
-            # file.write(f"{hit.n}\t{i}\t{hit.obj.name :>20}\t{hit.start}\t{hit.coord()}\n")
-            # TODO update hit and tri class
-            point_coords = calcTextureCoordinate(
-                hit.u, hit.v, 1 - hit.u - hit.v, hit.tri.textureCoords
-            )
-            file.write(
-                f"{hit.obj.name}\t{i}\t"
-                # + f"{hit.u},{hit.v}\t{hit.tri.textureCoords[0][0]},{hit.tri.textureCoords[0][1]}\t"
-                # + f"{hit.tri.textureCoords[1][0]},{hit.tri.textureCoords[1][1]}\t"
-                # + f"{hit.tri.textureCoords[2][0]},{hit.tri.textureCoords[2][1]}\t"
-                + f"{point_coords[0]},{point_coords[1]}\n"
-            )
+def blockSeed(entropy: int, b0: int) -> int:
+    """
+    :param entropy: seed of the run, see Emitters.PointSource.seed
+    :param b0: first ray of the block
+    :return: 32 bit seed of the block, from its own stream SeedSequence(entropy,
+        spawn_key=(b0,)) as the Emitters chunks do
+    """
+    return int(np.random.SeedSequence(entropy, spawn_key=(b0,)).generate_state(1)[0])
 
 
 def iterateStartVecs(
-    n0, n, N, objs, results=None, shouldPrint=False, pid=0, lock=None
+    n0,
+    n,
+    N,
+    objs,
+    results=None,
+    shouldPrint=False,
+    pid=0,
+    lock=None,
+    engine=None,
+    mode="full",
+    emitter=None,
+    seed=None,
 ) -> dict:
     """
-    Iterate over source vectors from n0 to n
+    Compiled version of twobounce2.iterateStartVecs, same arguments and stats dictionary
+    Without an emitter, rays come from a static point source at the origin with random
+    theta and phi, block b0 seeded from seed and b0 (see blockSeed)
     :param n0: starting n
     :param n: ending n
-    :param objs: list of objects
-    :param results: deprecated? (default: none)
-    :param shouldPrint: should print precentage (default: false)
+    :param objs: TriangleMesh (or list of objects, packed on first use)
     :param pid: process id (default: 0)
-    :return: void?
+    :param lock: lock for the progress bar
+    :param mode: "full" writes hits to ./output, "stats" only counts them
+    :param emitter: source from Emitters giving reproducible (and weighted) rays
+        (default: None)
+    :param seed: integer seed of the rays without an emitter, the same seed gives the
+        same rays (default: None, a random one, so every call traces new rays)
+    :return: stats dictionary
     """
-    LENGTH = 500  # length of "pencil"
-    if results is None:
-        results = []
+    from twobounce2 import asMesh, writeHits, hitFlags, addStats
+
+    mesh = asMesh(objs)
+    arrays = traceArrays(mesh)
+    start = np.zeros(3)  # static point
     stats = {
         "num_rays": 0,
         "hit_obj": 0,
         "hit_critical": 0,
     }
-
-    prec = 0  # percent tracker
-    outFile = open(f"./output/output_{pid}.txt", "w")
-
-    with lock:  # show progress bars (sem lock to prevent overwriting each other)
+    outFile = open(f"./output/output_{pid}.txt", "w") if mode == "full" else None
+    with lock:
         bar = tqdm(
             position=pid,
             leave=False,
@@ -298,111 +462,28 @@ def iterateStartVecs(
             colour="green",
             ascii=True,
         )
-
-    div = (n - n0) // 7500  # used for progress bar
-
-    for t in range(n0, n):
-        if t % 7500 == 0:  # update progress bar in some interval
-            with lock:
-                bar.update(7500)
-
-        ###############################################################
-        # DEFINE VECTOR ITERATION
-        # start = Vector(0, 250 - t * LENGTH / N, 50) # moving point
-        start = Vector(0, 0, 0)  # static point
-        theta = r.random() * math.pi  # random theta
-        phi = r.random() * 2 * math.pi  # random phi
-
-        # dir = Vector(1, 0, 0)  # use spherical coords to calculate direction vector
-        dir = Vector(cos(phi) * sin(theta), sin(theta) * sin(phi), cos(theta))
-
-        res = twobounce(objs, start, dir)  # call two bounces and get responses
-        res[0].n = t
-        res[1].n = t
-        ##########################################################
-        # Get stats
-        # Track rays that hit critical geometry at any point in their path
-        # or that hit objects at any point in their path
-        thisHits = 0
-        thisCrits = 0
-        for hit in res:
-            if hit.obj and hit.obj.critial:
-                thisCrits += 1
-            if hit.hit:
-                thisHits += 1
-        stats["hit_critical"] += 1 if thisCrits else 0
-        stats["hit_obj"] += 1 if thisHits else 0
-        stats["num_rays"] += 1
-        ##############################################
-        # results += res
-        # Write to file if hits critical geometry (TODO change to all geometry once file loading is working)
-
-        # pass
-        writeToFile(outFile, res)
-    bar.close()  # end bar
-    outFile.close()  # done writing to file
-
-    if results is not None:
-        return stats
-
-
-def multicoreIterateMap(objs, N) -> list[dict]:
-    division = N // CPU_COUNT
-    lock = mp.Manager().Lock()  # lock for prog. bars
-    # list of parameters to map to functions
-    divisionList = [
-        (i * division, (i + 1) * division, N, objs, None, None, i, lock)
-        for i in range(CPU_COUNT)
-    ]
-
-    with mp.Pool(processes=CPU_COUNT) as pool:
-        res = pool.starmap(iterateStartVecs, divisionList)
-
-    printf()
-    return res
-
-
-# objs, ns, results=None, pid=0)
-def test(sd, results=None):
-    print(sd)
-
-
-def _multicoreIterate(objs, n=1_000_000):
-    """
-    DEPRECATED, use multicoreIterateMap instead
-    Create CPU_COUNT processes that will work on a division of the n events, calls iterateStartVecs
-    :param objs: List of objects
-    :param n: Number of events
-    :return: void
-    """
-    division = n // CPU_COUNT
-    processes = []
-    results = []
-
-    otherArgs = (objs, None)
-    for i in range(CPU_COUNT):
-        shouldPrint = not i  # only true on i=0
-        p = mp.Process(
-            target=iterateStartVecs,
-            args=(i * division, (i + 1) * division, objs, results, shouldPrint, i),
-        )
-        processes.append(p)
-        p.start()
-    for proc in processes:
-        proc.join()
-
-    # for process in processes:
-    # process.join()
-    return results
-
-
-"""
-TODO checklist:
-_ Bounding box? -> May not be needed, unsure until more complex geometry is implemented
-_ Change ObjLoader -> in progress -> Done
-_ Make hit information class -> Done
-_ Make method to check interesctions and calculate reflections -> in progress -> Done
-_ Impelment emitter and number of vectors -> in progress -> Done
-_ Multiprocessing? -> Done
-
-"""
+    if emitter is None:
+        blocks = ((b0, min(b0 + BLOCK, n)) for b0 in range(n0, n, BLOCK))
+        entropy = np.random.SeedSequence(seed).entropy
+    else:
+        blocks = emitter.blocks(n0, n)
+    for b0, b1 in blocks:
+        if emitter is None:
+            hit_obj, hit_critical, faces, us, vs = traceBlock(
+                blockSeed(entropy, b0), b1 - b0, start, *arrays
+            )
+            stats["num_rays"] += b1 - b0
+            stats["hit_obj"] += int(hit_obj)
+            stats["hit_critical"] += int(hit_critical)
+        else:
+            starts, dirs = emitter.rays(b0, b1)
+            _, _, faces, us, vs = traceRays(np.ascontiguousarray(starts), dirs, *arrays)
+            addStats(stats, *hitFlags(mesh, faces), emitter.weights(dirs))
+        if outFile:
+            writeHits(outFile, mesh, faces, us, vs)
+        with lock:
+            bar.update(b1 - b0)
+    bar.close()
+    if outFile:
+        outFile.close()
+    return stats